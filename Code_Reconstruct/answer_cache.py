@@ -0,0 +1,74 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+import numpy as np
+
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE", "true").lower() == "true"
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", 0.95)) # cosine similarity
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", 256))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", 24 * 3600))         # seconds
+
+class SemanticCache:
+    # Answers keyed by query embedding: a new question whose embedding is within threshold
+    # cosine similarity of a cached one reuses its answer, sources and images. Entries expire
+    # after ttl seconds, the least recently used go first when full, and everything is dropped
+    # when version() changes, i.e. when the text or image index was rebuilt.
+    def __init__(self, version=lambda: None, threshold=ANSWER_CACHE_THRESHOLD,
+                 max_entries=ANSWER_CACHE_MAX_ENTRIES, ttl=ANSWER_CACHE_TTL):
+        self.version = version
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict() # id -> (vector, created, value)
+        self.next_id = 0
+        self.current_version = version()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def check_version(self):
+        version = self.version()
+        if version != self.current_version:
+            self.entries.clear()
+            self.current_version = version
+
+    def expire(self):
+        now = time.time()
+        for entry_id in [i for i, (_, created, _) in self.entries.items() if now - created > self.ttl]:
+            del self.entries[entry_id]
+
+    def lookup(self, vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        vector /= np.linalg.norm(vector) or 1.0
+        with self.lock:
+            self.check_version()
+            self.expire()
+            if self.entries:
+                ids = list(self.entries)
+                similarities = np.stack([self.entries[i][0] for i in ids]).astype(np.float32) @ vector
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.threshold:
+                    self.entries.move_to_end(ids[best])
+                    self.hits += 1
+                    return self.entries[ids[best]][2]
+            self.misses += 1
+            return None
+
+    def store(self, vector, value):
+        vector = np.asarray(vector, dtype=np.float32)
+        vector /= np.linalg.norm(vector) or 1.0
+        with self.lock:
+            self.entries[self.next_id] = (vector.astype(np.float16), time.time(), value) # half the memory
+            self.next_id += 1
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
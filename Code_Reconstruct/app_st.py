@@ -1,15 +1,13 @@
+import time
+rerun_start = time.perf_counter() # Streamlit runs this script again on every interaction
 import streamlit as st
 import os
-from dotenv import load_dotenv, find_dotenv
-from azure.core.credentials import AzureKeyCredential
-from azure.search.documents import SearchClient
-from azure.search.documents.indexes.models import *
-from azure.search.documents.models import VectorizedQuery
-import openai
-from openai import AzureOpenAI
-import re
-from setup import text_search_client, image_search_client, azure_openai_client, get_embedding
-from filter_images import filter_images
+import pipeline
+import setup
+import thumbnails
+import tracing
+from history import ConversationMemory
+import_seconds = time.perf_counter() - rerun_start
 
 # Set the page layout to wide
 st.set_page_config(page_title="AIHA", page_icon="🔎", layout="wide")
@@ -34,87 +32,74 @@ history_init = [
 if "chat_history" not in st.session_state:
     st.session_state["chat_history"] = []
 
-# Initialize session state for OpenAI chat history if not already present
+# Initialize session state for OpenAI chat history if not already present,
+# earlier turns are resent without their sources and trimmed to a token budget
 if "history_openai" not in st.session_state:
-    st.session_state["history_openai"] = history_init
+    st.session_state["history_openai"] = ConversationMemory(history_init)
 
-# Function to handle user queries and generate responses
-def query_and_respond(query):
-    vector_query = get_embedding(query)
+# Per-stage breakdown of the last request in the UI, and Prometheus metrics on METRICS_PORT
+debug_panel = os.getenv("DEBUG_PANEL", "false").lower() == "true"
+if os.getenv("METRICS_PORT"):
+    tracing.start_metrics_server(int(os.getenv("METRICS_PORT")))
 
-    # Perform text search using vector-based queries
-    text_results = text_search_client.search(
-        search_text=None,
-        top=5,
-        vector_queries=[VectorizedQuery(vector=vector_query, fields="Embedding")],
-    )
-    # Perform neighboring search
-    sections = []
-    for result in text_results:
-        sections.append(result["id"])
-    print(sections)
-    search_text_results = []
-    used_sections = []
-    for sec in sections:
-        doc = text_search_client.get_document(key=sec)
-        if doc["id"] == "Chapter-Section-Paragraph": continue
-        print(doc["id"])
-        used_sections.append(doc["id"])
-        search_text_results.append("Source: " + doc["id"] + "; Content: " + doc["Content"])
-        try:
-            neighbor_sec = sec[:-2] + "-" + str(int(sec[-1]) + 1)
-            if neighbor_sec not in used_sections:
-                doc = text_search_client.get_document(key=neighbor_sec)
-                print(doc["id"])
-                used_sections.append(doc["id"])
-                search_text_results.append("Source: " + doc["id"] + "; Content: " + doc["Content"])
-        except:
-            pass
-        try:
-            neighbor_sec = sec[:-2] + "-" + str(int(sec[-1]) - 1)
-            if neighbor_sec not in used_sections:
-                doc = text_search_client.get_document(key=neighbor_sec)
-                print(doc["id"])
-                used_sections.append(doc["id"])
-                search_text_results.append("Source: " + doc["id"] + "; Content: " + doc["Content"])
-        except:
-            pass
-    # Update conversation history for AI response
-    chat_message = f"{query} Source: " + " ".join(search_text_results)
-    history_openai = st.session_state["history_openai"]
-    history_openai.append({"role": "user", "content": chat_message})
+# Render answer tokens as they arrive instead of waiting for the whole pipeline
+stream_answers = os.getenv("STREAM_ANSWER", "true").lower() == "true"
 
-    # Generate AI response using chat completions
-    response = azure_openai_client.chat.completions.create(
-        model="summer",
-        messages=history_openai,
-        temperature=0.7,
-    )
-    history_openai.append(
-        {"role": "assistant", "content": response.choices[0].message.content}
-    )
-    st.session_state["history_openai"] = history_openai
+# Function to handle user queries and render the response progressively
+def query_and_respond(query):
+    history_openai = st.session_state["history_openai"]
+    answer_box = st.empty()
+    ai_response = ""
+    for event, payload in pipeline.stream_query(query, history_openai, stream=stream_answers):
+        if event == "sources":
+            search_results = payload
+        elif event == "prompt_tokens":
+            print(f"Prompt tokens: {payload}")
+        elif event == "token":
+            ai_response += payload
+            answer_box.markdown(ai_response + "▌")
+        elif event == "answer":
+            ai_response = payload
+            st.session_state["chat_history"].append({"user": "AI", "message": ai_response})
+            # Show AI response
+            answer_box.text_area("AI:", value=ai_response, height=300, key="AI"+ai_response)
+            with st.expander("Sources"):
+                for source in search_results:
+                    st.write(source)
+        elif event == "images":
+            st.session_state["image_result"] = payload
+            show_images(payload)
+        elif event == "trace":
+            st.session_state["trace"] = payload
+        elif event == "timings":
+            st.session_state["history_openai"] = history_openai
+            st.session_state["timings"] = payload
+            # Perceived (first token) and total latency of every request in this session
+            st.session_state.setdefault("latency_log", []).append(
+                {"time_to_first_token": payload.get("time_to_first_token"), "total": payload["total"]}
+            )
+            print(payload)
+            with st.expander("Timings"):
+                st.json({stage: f"{seconds:.3f}s" for stage, seconds in payload.items()})
+                st.write(f"Prompt tokens per turn: {history_openai.prompt_tokens}")
+                st.write(f"Answer cache: {pipeline.answer_cache.stats()}")
+                st.write(f"Client startup (once per process): "
+                         f"{ {name: f'{seconds:.3f}s' for name, seconds in setup.startup_timings.items()} }")
+                st.write(f"Script overhead of the last rerun: {st.session_state.get('rerun_overhead', 0):.3f}s")
+            if debug_panel:
+                show_trace(st.session_state["trace"])
 
-    # Perform image search using vector-based KEYWORDS
-    chat_content = response.choices[0].message.content
-    image_search_keywords = chat_content.split("\n")[-1].replace("Keywords: ", "")
-    print(image_search_keywords)
-    image_results = image_search_client.search(
-        search_text=None,
-        top=5,
-        vector_queries=[VectorizedQuery(vector=get_embedding(image_search_keywords), fields="Embedding")],
-    )
-    image_search_results = [(result["Image_name"], result["Caption"]) for result in image_results]
-    filtered_image_names = filter_images(azure_openai_client, chat_content, image_search_results)
-    filtered_images = []
-    for i in image_search_results:
-        if i[0] in filtered_image_names:
-            filtered_images.append(i)
-    return (
-        response.choices[0].message.content,
-        search_text_results,
-        filtered_images,
-    )
+def show_trace(trace):
+    with st.expander("Debug: request trace"):
+        st.write(f"Trace {trace['trace']}, totals: {trace['totals']}")
+        st.dataframe(
+            [{"stage": span["name"], "parent": span["parent"], "start (s)": round(span["offset"], 3),
+              "seconds": round(span["seconds"], 3), "requests": span.get("requests", 0),
+              "prompt tokens": span.get("prompt_tokens", 0), "completion tokens": span.get("completion_tokens", 0),
+              "retries": span.get("retries", 0), "error": span["error"]}
+             for span in sorted(trace["spans"], key=lambda span: span["offset"])],
+            use_container_width=True,
+        )
 
 # Display the text bubbles with the chat history
 def show_chat_history():
@@ -138,17 +123,7 @@ def filename_converter(filename):
     image_title = ' '.join(word.capitalize() for word in name_cleaned.split())
     return image_title
 
-# User interface for chat interaction
-user_input = st.chat_input("Type your message here:")
-if user_input:
-    st.session_state["chat_history"].append({"user": "You", "message": user_input})
-    # Show chat history so far
-    show_chat_history()
-    ai_response, search_results, image_result = query_and_respond(user_input)
-    st.session_state["chat_history"].append({"user": "AI", "message": ai_response})
-    # Show AI response
-    st.text_area("AI:", value=ai_response, height=300, key="AI"+ai_response)
-    
+def show_images(image_result):
     if image_result != ['']:
         # Extract and display images from the search results
         with st.sidebar:
@@ -156,4 +131,22 @@ if user_input:
             for i in range(len(image_result)):
                 if image_result[i][1] == 'None': caption = filename_converter(image_result[i][0])
                 else: caption = image_result[i][1]
-                st.image("./jpg/" + str(image_result[i][0]), caption=caption)
\ No newline at end of file
+                # Sidebar-sized thumbnail, the original file is only sent when asked for
+                st.image(thumbnails.get_thumbnail(str(image_result[i][0])), caption=caption)
+                if st.checkbox("Full resolution", key="full_" + str(image_result[i][0])):
+                    st.image("./jpg/" + str(image_result[i][0]))
+
+# User interface for chat interaction
+user_input = st.chat_input("Type your message here:")
+# Time from the start of this rerun until the page is ready for the request (imports included)
+st.session_state["rerun_overhead"] = time.perf_counter() - rerun_start
+print(f"Rerun overhead {st.session_state['rerun_overhead']:.3f}s (imports {import_seconds:.3f}s)")
+if user_input:
+    st.session_state["chat_history"].append({"user": "You", "message": user_input})
+    # Show chat history so far
+    show_chat_history()
+    query_and_respond(user_input)
+elif "image_result" in st.session_state:
+    # Reruns from the sidebar (e.g. a full resolution toggle) keep the last results on screen
+    show_chat_history()
+    show_images(st.session_state["image_result"])
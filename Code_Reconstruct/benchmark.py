@@ -0,0 +1,210 @@
+import io
+import os
+import re
+import json
+import time
+import zlib
+import random
+import shutil
+import argparse
+import tempfile
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+# Defaults for a checkout without .env, setup reads them at import
+os.environ.setdefault("TEXT_EMBEDDING_MODEL_NAME", "fake-embedding")
+os.environ.setdefault("AZURE_SEARCH_INDEX_NAME_TEXT", "benchmark-text")
+os.environ.setdefault("AZURE_SEARCH_INDEX_NAME_IMAGE", "benchmark-images")
+
+import setup
+import tracing
+import manifest
+import section_index
+import image_links
+from fakes import Faults, FakeAzureOpenAI, FakeSearchIndexClient
+from embedding_cache import EmbeddingCache
+from ingest import ingest, read_csv
+from schemas import TEXT, IMAGE
+from history import ConversationMemory
+
+# Ingestion throughput and query latency without Azure: the clients in setup are replaced by
+# the stand-ins in fakes.py, with latency, errors and 429s set on the command line.
+#   python benchmark.py --queries 50 --mode both --throttle-rate 0.02
+# Index names are prefixed with "benchmark-" and everything written is removed at the end.
+HERE = os.path.dirname(os.path.abspath(__file__))
+TEXT_CSV = os.path.join(HERE, "data", "ch4to6.csv")
+IMAGE_CSV = os.path.join(os.path.dirname(HERE), "OHNO", "outputupdated.csv")
+TEXT_INDEX = "benchmark-text"
+IMAGE_INDEX = "benchmark-images"
+
+def text_rows(repeat=1, shard=0, shards=1):
+    # data/ch4to6.csv, repeated with a different chapter to scale up. With several shards each
+    # gets whole sections, as if the book were split across indexes by chapter range
+    for copy in range(repeat):
+        for item in read_csv(TEXT_CSV):
+            chapter = item[0] if copy == 0 else f"{item[0]}r{copy}"
+            if zlib.crc32(f"{chapter}-{item[1]}".encode()) % shards == shard:
+                yield [chapter] + item[1:]
+
+def text_index_names(shards):
+    return [TEXT_INDEX] if shards == 1 else [f"{TEXT_INDEX}-{shard}" for shard in range(shards)]
+
+def image_rows(repeat=1):
+    # OHNO/outputupdated.csv, repeated under different image names
+    for copy in range(repeat):
+        for item in read_csv(IMAGE_CSV):
+            yield [item[0] if copy == 0 else f"{copy}-{item[0]}"] + item[1:]
+
+def make_questions(n, seed):
+    # Questions about names and places that occur in the book, the same ones for a given seed
+    names = sorted({name for item in read_csv(TEXT_CSV)
+                    for name in re.findall(r"\b[A-Z][a-z]+(?: [A-Z][a-z]+)+", item[3])})
+    rng = random.Random(seed)
+    templates = ["Who was {}?", "What role did {} play in founding the university?", "Tell me about {}."]
+    return [rng.choice(templates).format(rng.choice(names)) for _ in range(n)]
+
+def run_ingestion(schema, rows, search_client, index_name, source_name):
+    # Embedding and upload of every row through the streaming pipeline, as --full would do
+    report = ingest(schema, rows, search_client, index_name, source_name,
+                    setup.get_embeddings, setup.text_embedding_model, full=True)
+    return {"documents": report.uploaded, "failed": len(report.failed), "seconds": report.seconds,
+            "docs_per_second": report.uploaded / report.seconds if report.seconds else 0.0}
+
+def percentiles(values):
+    if not values:
+        return {}
+    values = np.asarray(values)
+    return {"p50": float(np.percentile(values, 50)), "p95": float(np.percentile(values, 95)),
+            "mean": float(values.mean()), "max": float(values.max())}
+
+def run_queries(questions, mode, stream, users):
+    import pipeline
+    errors = {}
+    timings = []
+
+    def ask(question):
+        try:
+            *_, stage_timings = pipeline.query_and_respond(question, ConversationMemory([]), mode=mode, stream=stream)
+            return stage_timings
+        except Exception as e:
+            errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
+            return None
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=users) as executor:
+        timings = [t for t in executor.map(ask, questions) if t is not None]
+    seconds = time.perf_counter() - start
+    stages = sorted({stage for t in timings for stage in t} - {"total", "time_to_first_token"})
+    return {
+        "mode": mode,
+        "queries": len(questions),
+        "errors": errors,
+        "queries_per_second": len(questions) / seconds if seconds else 0.0,
+        "latency": percentiles([t["total"] for t in timings]),
+        "time_to_first_token": percentiles([t["time_to_first_token"] for t in timings if "time_to_first_token" in t]),
+        "stages": {stage: percentiles([t[stage] for t in timings if stage in t]) for stage in stages},
+    }
+
+def print_report(report):
+    for name in ("text_ingestion", "image_ingestion"):
+        r = report[name]
+        print(f"{name}: {r['documents']} docs in {r['seconds']:.2f}s ({r['docs_per_second']:.1f} docs/s), "
+              f"{r['failed']} failed")
+    for r in report["queries"]:
+        print(f"\nquery_and_respond [{r['mode']}]: {r['queries']} queries, {r['queries_per_second']:.2f} queries/s, "
+              f"errors {r['errors'] or 0}")
+        print(f"  {'stage':<28}{'p50':>10}{'p95':>10}")
+        rows = [("total", r["latency"]), ("time_to_first_token", r["time_to_first_token"])] + list(r["stages"].items())
+        for stage, p in rows:
+            if p:
+                print(f"  {stage:<28}{p.get('p50', 0) * 1000:>8.1f}ms{p.get('p95', 0) * 1000:>8.1f}ms")
+    print(f"\nfaults: {report['faults']}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline ingestion and query benchmark")
+    parser.add_argument("--queries", type=int, default=20)
+    parser.add_argument("--mode", choices=["concurrent", "serial", "both"], default="both")
+    parser.add_argument("--users", type=int, default=1, help="queries in flight at once")
+    parser.add_argument("--no-stream", action="store_true")
+    parser.add_argument("--repeat", type=int, default=1, help="copies of the source rows to ingest")
+    parser.add_argument("--shards", type=int, default=1, help="text indexes the book is split across")
+    parser.add_argument("--search-latency", type=float, default=0.03)
+    parser.add_argument("--embedding-latency", type=float, default=0.05)
+    parser.add_argument("--chat-latency", type=float, default=0.4, help="time to first token")
+    parser.add_argument("--token-latency", type=float, default=0.01)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=float, default=0.2)
+    parser.add_argument("--answer-cache", action="store_true", help="leave the semantic answer cache on")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="also write the report to this file")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    def faults(latency, seed):
+        return Faults(latency=latency, error_rate=args.error_rate, throttle_rate=args.throttle_rate,
+                      retry_after=args.retry_after, seed=args.seed + seed)
+    search_faults = faults(args.search_latency, 1)
+    embedding_faults = faults(args.embedding_latency, 2)
+    chat_faults = faults(args.chat_latency, 3)
+
+    workdir = tempfile.mkdtemp(prefix="benchmark-")
+    index_client = FakeSearchIndexClient(os.path.join(workdir, "index"), search_faults)
+    text_indexes = text_index_names(args.shards)
+    setup.text_search_index_name = text_indexes[0]
+    setup.text_search_index_names = text_indexes
+    setup.image_search_index_name = IMAGE_INDEX
+    text_clients = {name: index_client.get_search_client(name) for name in text_indexes}
+    setup.override(
+        index_client=index_client,
+        text_search_client=text_clients[text_indexes[0]],
+        text_search_clients=text_clients,
+        image_search_client=index_client.get_search_client(IMAGE_INDEX),
+        azure_openai_client=FakeAzureOpenAI(embedding_faults, chat_faults, args.token_latency),
+        embedding_cache=EmbeddingCache(os.path.join(workdir, "embeddings.sqlite3")),
+    )
+    tracing.TRACE_LOG = ""
+    quiet = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+
+    report = {"config": vars(args)}
+    try:
+        with quiet:
+            shard_reports = [run_ingestion(TEXT, text_rows(args.repeat, shard, args.shards), text_clients[name],
+                                           name, os.path.basename(TEXT_CSV))
+                             for shard, name in enumerate(text_indexes)]
+            seconds = sum(r["seconds"] for r in shard_reports)
+            documents = sum(r["documents"] for r in shard_reports)
+            report["text_ingestion"] = {"documents": documents, "failed": sum(r["failed"] for r in shard_reports),
+                                        "seconds": seconds, "docs_per_second": documents / seconds if seconds else 0.0}
+            report["image_ingestion"] = run_ingestion(IMAGE, image_rows(args.repeat), setup.image_search_client,
+                                                      IMAGE_INDEX, os.path.basename(IMAGE_CSV))
+            for name in text_indexes:
+                image_links.build_image_links(name, IMAGE_CSV, setup.get_embeddings)
+            import pipeline
+            pipeline.ANSWER_CACHE_ENABLED = args.answer_cache
+            questions = make_questions(args.queries, args.seed)
+            modes = ["serial", "concurrent"] if args.mode == "both" else [args.mode]
+            report["queries"] = []
+            for mode in modes:
+                # Every mode starts with no query embeddings cached, as for new questions
+                setup.override(embedding_cache=EmbeddingCache(os.path.join(workdir, f"embeddings-{mode}.sqlite3")))
+                report["queries"].append(run_queries(questions, mode, not args.no_stream, args.users))
+        report["faults"] = {"search": search_faults.stats(), "embeddings": embedding_faults.stats(),
+                            "chat": chat_faults.stats()}
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+        for directory in (manifest.DEFAULT_DIR, section_index.DEFAULT_DIR):
+            for index_name in text_indexes + [IMAGE_INDEX]:
+                shutil.rmtree(os.path.join(directory, index_name), ignore_errors=True)
+        for index_name in text_indexes:
+            if os.path.exists(image_links.links_path(index_name)):
+                os.remove(image_links.links_path(index_name))
+
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+import os
+import json
+import time
+import random
+from concurrent.futures import ThreadPoolExecutor
+from azure.core.exceptions import HttpResponseError, ServiceRequestError, ServiceResponseError
+
+# Azure AI Search accepts at most 1000 documents and 16 MB of payload per indexing request
+MAX_BATCH_DOCS = int(os.getenv("UPLOAD_BATCH_DOCS", 1000))
+MAX_BATCH_BYTES = int(os.getenv("UPLOAD_BATCH_BYTES", 15 * 1024 * 1024)) # leave headroom for the envelope
+UPLOAD_WORKERS = int(os.getenv("UPLOAD_WORKERS", 4))
+MAX_RETRIES = int(os.getenv("UPLOAD_MAX_RETRIES", 4))
+BACKOFF_SECONDS = 1.0
+
+# Per-document status codes worth sending again (conflicts, throttling, transient service errors)
+RETRYABLE_STATUS = {409, 422, 429, 500, 502, 503, 504}
+
+ACTIONS = {
+    "upload": "upload_documents",
+    "merge": "merge_documents",
+    "mergeOrUpload": "merge_or_upload_documents",
+    "delete": "delete_documents",
+}
+
+class UploadReport:
+    def __init__(self, action):
+        self.action = action
+        self.succeeded = []   # keys
+        self.failed = {}      # key -> "status: message"
+        self.documents = 0
+        self.bytes = 0
+        self.requests = 0
+        self.retries = 0
+        self.seconds = 0.0
+
+    def docs_per_second(self):
+        return self.documents / self.seconds if self.seconds else 0.0
+
+    def mb_per_second(self):
+        return self.bytes / 1024 / 1024 / self.seconds if self.seconds else 0.0
+
+    def summary(self):
+        return (f"{self.action}: {len(self.succeeded)}/{self.documents} succeeded in {self.requests} requests "
+                f"({self.retries} retried) in {self.seconds:.1f}s, "
+                f"{self.docs_per_second():.1f} docs/s, {self.mb_per_second():.2f} MB/s")
+
+def document_size(document):
+    return len(json.dumps(document, ensure_ascii=False).encode("utf-8"))
+
+def iter_batches(documents, max_docs=MAX_BATCH_DOCS, max_bytes=MAX_BATCH_BYTES):
+    # Greedily packs documents into (batch, bytes) bounded by count and serialized size, each
+    # batch is yielded as soon as it is full so the documents can come from a stream
+    batch, batch_bytes = [], 0
+    for document in documents:
+        size = document_size(document)
+        if batch and (len(batch) >= max_docs or batch_bytes + size > max_bytes):
+            yield batch, batch_bytes
+            batch, batch_bytes = [], 0
+        batch.append(document)
+        batch_bytes += size
+    if batch:
+        yield batch, batch_bytes
+
+def make_batches(documents, max_docs=MAX_BATCH_DOCS, max_bytes=MAX_BATCH_BYTES):
+    return list(iter_batches(documents, max_docs, max_bytes))
+
+def backoff(attempt):
+    time.sleep(BACKOFF_SECONDS * 2 ** attempt + random.uniform(0, BACKOFF_SECONDS))
+
+def send_batch(client, method, documents, key_field, max_retries):
+    # Returns (succeeded keys, {failed key: reason}, requests made, retries)
+    succeeded, failed = [], {}
+    requests, retries = 0, 0
+    pending = documents
+    for attempt in range(max_retries + 1):
+        if attempt:
+            retries += 1
+            backoff(attempt - 1)
+        requests += 1
+        try:
+            results = getattr(client, method)(documents=pending)
+        except HttpResponseError as e:
+            if e.status_code == 413 and len(pending) > 1:
+                # Payload still too large for the service, split it in two
+                mid = len(pending) // 2
+                for half in (pending[:mid], pending[mid:]):
+                    s, f, r, rt = send_batch(client, method, half, key_field, max_retries)
+                    succeeded += s
+                    failed.update(f)
+                    requests += r
+                    retries += rt
+                return succeeded, failed, requests, retries
+            if e.status_code not in RETRYABLE_STATUS or attempt == max_retries:
+                failed.update({d[key_field]: f"{e.status_code}: {e.message}" for d in pending})
+                return succeeded, failed, requests, retries
+            continue
+        except (ServiceRequestError, ServiceResponseError) as e:
+            if attempt == max_retries:
+                failed.update({d[key_field]: str(e) for d in pending})
+                return succeeded, failed, requests, retries
+            continue
+
+        retry_keys = set()
+        for r in results:
+            if r.succeeded:
+                succeeded.append(r.key)
+                failed.pop(r.key, None)
+            else:
+                failed[r.key] = f"{r.status_code}: {r.error_message}"
+                if r.status_code in RETRYABLE_STATUS:
+                    retry_keys.add(r.key)
+        if not retry_keys or attempt == max_retries:
+            break
+        # Only the documents that failed transiently are sent again
+        pending = [d for d in pending if d[key_field] in retry_keys]
+    return succeeded, failed, requests, retries
+
+def bulk_index(client, documents, action="mergeOrUpload", key_field="id",
+               max_docs=MAX_BATCH_DOCS, max_bytes=MAX_BATCH_BYTES,
+               workers=UPLOAD_WORKERS, max_retries=MAX_RETRIES):
+    # Sends documents in size-bounded batches over a bounded worker pool, retrying only failed keys
+    method = ACTIONS[action]
+    report = UploadReport(action)
+    batches = make_batches(documents, max_docs, max_bytes)
+    report.documents = len(documents)
+    report.bytes = sum(batch_bytes for _, batch_bytes in batches)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(batches)))) as executor:
+        futures = [executor.submit(send_batch, client, method, batch, key_field, max_retries)
+                   for batch, _ in batches]
+        for future in futures:
+            succeeded, failed, requests, retries = future.result()
+            report.succeeded += succeeded
+            report.failed.update(failed)
+            report.requests += requests
+            report.retries += retries
+    report.seconds = time.perf_counter() - start
+    print(report.summary())
+    for key, reason in report.failed.items():
+        print(f"  failed {key}: {reason}")
+    return report
@@ -0,0 +1,125 @@
+import os
+import numpy as np
+
+from section_index import split_key
+from tokenizer import count_tokens, truncate
+
+# Sources for the chat prompt within CONTEXT_TOKEN_BUDGET tokens. Every paragraph of the
+# expanded context is a candidate once, however many hits it neighbours. Candidates are taken
+# by maximal marginal relevance (relevance to the question minus CONTEXT_MMR_LAMBDA-weighted
+# similarity to what is already packed) until the budget is full, and the packed paragraphs
+# that follow each other in a section are sent as one span. Relevance and similarity come
+# from the cached paragraph embeddings, a paragraph without one counts as a fresh source with
+# the relevance of the hit it belongs to.
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", 2000))
+CONTEXT_MMR_LAMBDA = float(os.getenv("CONTEXT_MMR_LAMBDA", 0.7))
+SOURCE_OVERHEAD_TOKENS = 8 # "Source: ...; Content: " around every span
+
+class Span:
+    def __init__(self, section, paragraphs):
+        self.section = section
+        self.paragraphs = paragraphs   # [(position, id, content)] in reading order
+
+    @property
+    def doc_id(self):
+        first, last = self.paragraphs[0][1], self.paragraphs[-1][1]
+        return first if first == last else f"{first} to {last}"
+
+    @property
+    def content(self):
+        return "\n".join(content for _, _, content in self.paragraphs)
+
+def similarity_from_score(score):
+    # Inverse of Azure's cosine @search.score, 1 / (2 - cosine)
+    return 2.0 - 1.0 / score if score else 0.0
+
+def location(doc_id, section_index):
+    # (section, position) for merging neighbours, None when the id says nothing about it
+    if section_index is not None and doc_id in section_index:
+        return section_index.positions[doc_id]
+    try:
+        chapter, section, paragraph = split_key(doc_id)
+        return f"{chapter}-{section}", int(paragraph)
+    except ValueError:
+        return None
+
+def mmr_order(relevance, vectors, lambda_=CONTEXT_MMR_LAMBDA):
+    # Candidate positions in MMR order, vectors[i] is a unit vector or None
+    relevance = np.asarray(relevance, dtype=np.float32)
+    has_vector = np.array([vector is not None for vector in vectors])
+    matrix = np.stack([vector for vector in vectors if vector is not None]) if has_vector.any() else None
+    rows = np.cumsum(has_vector) - 1   # candidate -> row of matrix
+    redundancy = np.zeros(len(relevance), dtype=np.float32) # max similarity to the packed ones
+    remaining = np.ones(len(relevance), dtype=bool)
+    order = []
+    while remaining.any():
+        marginal = np.where(remaining, lambda_ * relevance - (1 - lambda_) * redundancy, -np.inf)
+        best = int(np.argmax(marginal))
+        remaining[best] = False
+        order.append(best)
+        if has_vector[best]:
+            similarity = np.zeros(len(relevance), dtype=np.float32)
+            similarity[has_vector] = matrix @ matrix[rows[best]]
+            redundancy = np.maximum(redundancy, similarity)
+    return order
+
+def pack_context(query_vector, hits, context, embedding_lookup=None, section_index=None,
+                 budget=CONTEXT_TOKEN_BUDGET, lambda_=CONTEXT_MMR_LAMBDA):
+    # hits: [(id, content, score, ...)] from the search, context: [(id, content)] after expansion.
+    # embedding_lookup(texts) -> {position: vector} without calling the API, e.g. the embedding cache.
+    # Returns ([Span] best first, stats)
+    candidates = list(dict(context).items())
+    hit_relevance = {hit[0]: similarity_from_score(hit[2]) for hit in hits}
+    found = embedding_lookup([content for _, content in candidates]) if embedding_lookup and candidates else {}
+    query = np.asarray(query_vector, dtype=np.float32)
+    query /= np.linalg.norm(query) or 1.0
+    vectors, relevance = [], []
+    fallback = min(hit_relevance.values(), default=0.0)
+    for i, (doc_id, _) in enumerate(candidates):
+        vector = found.get(i)
+        if vector is not None:
+            vector = np.asarray(vector, dtype=np.float32)
+            vector /= np.linalg.norm(vector) or 1.0
+            relevance.append(float(vector @ query))
+        else:
+            relevance.append(hit_relevance.get(doc_id, fallback))
+        vectors.append(vector)
+
+    tokens = [count_tokens(content) for _, content in candidates]
+    order = mmr_order(relevance, vectors, lambda_)
+    packed, used = [], 0
+    for i in order:
+        cost = tokens[i] + SOURCE_OVERHEAD_TOKENS
+        if used + cost <= budget:
+            packed.append(i)
+            used += cost
+    if order and not packed:
+        # Not even one paragraph fits, send the start of the best one
+        best = order[0]
+        candidates[best] = (candidates[best][0], truncate(candidates[best][1], max(0, budget - SOURCE_OVERHEAD_TOKENS))[0])
+        packed.append(best)
+
+    # Consecutive packed paragraphs of a section become one span, spans are ordered by the MMR
+    # rank of their best paragraph
+    runs = {}   # section -> [(position, rank, id, content)]
+    for rank, i in enumerate(packed):
+        doc_id, content = candidates[i]
+        section, position = location(doc_id, section_index) or ((doc_id,), 0)
+        runs.setdefault(section, []).append((position, rank, doc_id, content))
+    ranked_spans = []
+    for section, paragraphs in runs.items():
+        paragraphs.sort()
+        span = None
+        for position, rank, doc_id, content in paragraphs:
+            if span is None or position != span.paragraphs[-1][0] + 1:
+                span = Span(section, [])
+                ranked_spans.append([rank, span])
+            span.paragraphs.append((position, doc_id, content))
+            ranked_spans[-1][0] = min(ranked_spans[-1][0], rank)
+    spans = [span for _, span in sorted(ranked_spans, key=lambda item: item[0])]
+
+    raw = sum(tokens) + SOURCE_OVERHEAD_TOKENS * len(candidates)
+    packed_tokens = sum(count_tokens(span.content) + SOURCE_OVERHEAD_TOKENS for span in spans)
+    stats = {"paragraphs": len(candidates), "packed_paragraphs": len(packed), "spans": len(spans),
+             "raw_tokens": raw, "packed_tokens": packed_tokens}
+    return spans, stats
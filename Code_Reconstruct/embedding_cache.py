@@ -0,0 +1,97 @@
+import os
+import hashlib
+import sqlite3
+import threading
+import time
+import numpy as np
+
+# One cache file shared by the indexing scripts and the app
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "embeddings.sqlite3")
+DEFAULT_MAX_ENTRIES = 20000 # ~60 MB of 1536-dim float16 vectors
+VECTOR_DTYPE = "float16"    # what new entries are stored as, like the Edm.Half index fields
+
+def normalize_text(text):
+    return " ".join(text.split())
+
+def cache_key(model, text):
+    return hashlib.sha256(f"{model}\0{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+class EmbeddingCache:
+    # Content-addressed on-disk cache of embeddings keyed by (deployment, normalized text hash),
+    # vectors are stored as float16 blobs (entries from before as float32, as the dtype column
+    # says) and come back as float32 arrays. The least recently used entries are evicted
+    def __init__(self, path=DEFAULT_PATH, max_entries=DEFAULT_MAX_ENTRIES):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, model TEXT NOT NULL, vector BLOB NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(embeddings)")}
+        if "dtype" not in columns:
+            self.conn.execute("ALTER TABLE embeddings ADD COLUMN dtype TEXT NOT NULL DEFAULT 'float32'")
+        self.conn.commit()
+
+    def get_many(self, model, texts):
+        # Returns {position: float32 array} for the texts found in the cache
+        keys = [cache_key(model, text) for text in texts]
+        found = {}
+        with self.lock:
+            for start in range(0, len(keys), 500):
+                chunk = list(set(keys[start:start + 500]))
+                placeholders = ",".join("?" * len(chunk))
+                rows = self.conn.execute(
+                    f"SELECT key, vector, dtype FROM embeddings WHERE key IN ({placeholders})", chunk
+                ).fetchall()
+                for key, blob, dtype in rows:
+                    found[key] = np.frombuffer(blob, dtype=dtype).astype(np.float32)
+            if found:
+                self.conn.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                    [(time.time(), key) for key in found],
+                )
+                self.conn.commit()
+            results = {i: found[key] for i, key in enumerate(keys) if key in found}
+            self.hits += len(results)
+            self.misses += len(keys) - len(results)
+        return results
+
+    def put_many(self, model, texts, vectors):
+        now = time.time()
+        rows = [
+            (cache_key(model, text), model, np.asarray(vector, dtype=VECTOR_DTYPE).tobytes(), now, VECTOR_DTYPE)
+            for text, vector in zip(texts, vectors)
+        ]
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, model, vector, last_used, dtype) VALUES (?, ?, ?, ?, ?)", rows
+            )
+            self.evict()
+            self.conn.commit()
+
+    def evict(self):
+        (count,) = self.conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+        if count > self.max_entries:
+            self.conn.execute(
+                "DELETE FROM embeddings WHERE key IN "
+                "(SELECT key FROM embeddings ORDER BY last_used LIMIT ?)",
+                (count - self.max_entries,),
+            )
+
+    def stats(self):
+        with self.lock:
+            (entries,) = self.conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "entries": entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,92 @@
+import os
+import re
+import openai
+import numpy as np
+import tracing
+
+from embedding_cache import normalize_text
+from tokenizer import truncate
+
+# Request limits of the embedding deployment, override in .env if the deployment differs.
+# 16 inputs is what every Azure ada-002 deployment accepts, newer ones take up to 2048
+MAX_BATCH_ITEMS = int(os.getenv("EMBEDDING_BATCH_ITEMS", 16))      # inputs per request
+MAX_BATCH_TOKENS = int(os.getenv("EMBEDDING_BATCH_TOKENS", 96000)) # tokens per request
+MAX_INPUT_TOKENS = 8191                                            # tokens per input (text-embedding-ada-002)
+
+# Deployment -> inputs per request it accepted after rejecting a larger batch, so later
+# requests start at that size instead of being rejected and split again
+accepted_batch_items = {}
+BATCH_LIMIT_ERROR = re.compile(r"too many inputs|number of inputs|tokens per request", re.IGNORECASE)
+
+def prepare_text(text):
+    # Same normalisation get_embedding has always applied, plus truncation to the input limit
+    text = text.replace("\n", " ")
+    return truncate(text, MAX_INPUT_TOKENS)
+
+def make_batches(token_counts, max_items=MAX_BATCH_ITEMS, max_tokens=MAX_BATCH_TOKENS):
+    # Greedily pack consecutive inputs, returns a list of index lists
+    batches, batch, batch_tokens = [], [], 0
+    for i, n_tokens in enumerate(token_counts):
+        if batch and (len(batch) >= max_items or batch_tokens + n_tokens > max_tokens):
+            batches.append(batch)
+            batch, batch_tokens = [], 0
+        batch.append(i)
+        batch_tokens += n_tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+def is_batch_limit_error(error):
+    # "Too many inputs. The max number of inputs is 16." or a per-request token limit
+    return bool(BATCH_LIMIT_ERROR.search(str(error)))
+
+def embed_batch(client, texts, model):
+    accepted = accepted_batch_items.get(model)
+    if accepted and len(texts) > accepted:
+        return embed_batch(client, texts[:accepted], model) + embed_batch(client, texts[accepted:], model)
+    try:
+        response = client.embeddings.create(input=texts, model=model)
+    except openai.BadRequestError as e:
+        # The deployment rejected the batch (too many inputs or tokens, or a bad input), split it
+        # and try again
+        if len(texts) == 1:
+            raise
+        tracing.add(retries=1)
+        mid = len(texts) // 2
+        first = embed_batch(client, texts[:mid], model)
+        if is_batch_limit_error(e):
+            # Only a size the deployment went on to accept is remembered
+            accepted_batch_items[model] = min(accepted_batch_items.get(model, mid), mid)
+        return first + embed_batch(client, texts[mid:], model)
+    tracing.add(requests=1, prompt_tokens=response.usage.prompt_tokens if response.usage else 0)
+    # The service may return the data out of order, the index field refers to the input position
+    return [np.asarray(item.embedding, dtype=np.float32) for item in sorted(response.data, key=lambda item: item.index)]
+
+def get_embeddings(client, texts, model, cache=None, max_items=MAX_BATCH_ITEMS, max_tokens=MAX_BATCH_TOKENS):
+    # Embed many texts with as few requests as possible, results are float32 arrays in input
+    # order (.tolist() where JSON is needed, e.g. a query vector or an uploaded document).
+    # With a cache, only texts never embedded before with this deployment reach the API
+    embeddings = [None] * len(texts)
+    if cache is not None:
+        for i, vector in cache.get_many(model, texts).items():
+            embeddings[i] = vector
+        tracing.add(cache_hits=sum(vector is not None for vector in embeddings))
+    # Embed each distinct missing text once
+    missing = {}
+    for i, text in enumerate(texts):
+        if embeddings[i] is None:
+            missing.setdefault(normalize_text(text), []).append(i)
+    if not missing:
+        return embeddings
+    missing_texts = [texts[positions[0]] for positions in missing.values()]
+    prepared = [prepare_text(text) for text in missing_texts]
+    vectors = [None] * len(prepared)
+    for batch in make_batches([n_tokens for _, n_tokens in prepared], max_items, max_tokens):
+        for i, vector in zip(batch, embed_batch(client, [prepared[i][0] for i in batch], model)):
+            vectors[i] = vector
+    if cache is not None:
+        cache.put_many(model, missing_texts, vectors)
+    for positions, vector in zip(missing.values(), vectors):
+        for i in positions:
+            embeddings[i] = vector
+    return embeddings
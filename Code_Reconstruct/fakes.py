@@ -0,0 +1,219 @@
+import re
+import time
+import random
+import hashlib
+import threading
+from types import SimpleNamespace
+from functools import lru_cache
+import numpy as np
+import httpx
+import openai
+from azure.core.exceptions import HttpResponseError
+
+from local_search import LocalSearchIndexClient
+from tokenizer import count_tokens
+
+# Offline stand-ins for SearchIndexClient, SearchClient and AzureOpenAI with the same surface
+# the pipeline and the ingestion code use. Search is the in-process backend of local_search.py,
+# embeddings are deterministic (hashed bag of words, so similar texts get similar vectors) and
+# every call goes through Faults, which adds latency and injects errors and 429s. Like the real
+# SDKs, a throttled or failed call is retried internally max_retries times before it raises.
+EMBEDDING_DIMENSIONS = 1536
+
+class Faults:
+    def __init__(self, latency=0.0, jitter=0.3, error_rate=0.0, throttle_rate=0.0,
+                 retry_after=0.2, max_retries=2, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.max_retries = max_retries
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.errors = 0
+        self.throttled = 0
+
+    def sleep(self, seconds):
+        with self.lock:
+            seconds *= 1 + self.jitter * self.rng.uniform(-1, 1)
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def outcome(self):
+        with self.lock:
+            self.calls += 1
+            roll = self.rng.random()
+            if roll < self.throttle_rate:
+                self.throttled += 1
+                return 429
+            if roll < self.throttle_rate + self.error_rate:
+                self.errors += 1
+                return 503
+            return None
+
+    def call(self, fn, make_error, extra_latency=0.0):
+        for attempt in range(self.max_retries + 1):
+            self.sleep(self.latency + extra_latency)
+            status = self.outcome()
+            if status is None:
+                return fn()
+            if attempt == self.max_retries:
+                raise make_error(status)
+            time.sleep(self.retry_after * 2 ** attempt)
+
+    def stats(self):
+        return {"calls": self.calls, "errors": self.errors, "throttled": self.throttled}
+
+# Embeddings
+
+@lru_cache(maxsize=65536)
+def word_vector(word):
+    seed = int.from_bytes(hashlib.md5(word.encode("utf-8")).digest()[:8], "little")
+    return np.random.default_rng(seed).standard_normal(EMBEDDING_DIMENSIONS).astype(np.float32)
+
+def fake_embedding(text):
+    words = re.findall(r"\w+", text.lower())
+    vector = np.zeros(EMBEDDING_DIMENSIONS, dtype=np.float32)
+    for word in words:
+        vector += word_vector(word)
+    vector /= np.linalg.norm(vector) or 1.0
+    return vector.tolist()
+
+def openai_error(status):
+    response = httpx.Response(status, request=httpx.Request("POST", "https://fake.openai.azure.com"),
+                              headers={"retry-after": "1"})
+    if status == 429:
+        return openai.RateLimitError("Rate limit is exceeded.", response=response, body=None)
+    return openai.InternalServerError("The service is temporarily unavailable.", response=response, body=None)
+
+class FakeEmbeddings:
+    def __init__(self, faults, max_inputs=2048, per_input_latency=0.0005):
+        self.faults = faults
+        self.max_inputs = max_inputs
+        self.per_input_latency = per_input_latency
+
+    def create(self, input, model, **kwargs):
+        texts = [input] if isinstance(input, str) else list(input)
+        if len(texts) > self.max_inputs:
+            response = httpx.Response(400, request=httpx.Request("POST", "https://fake.openai.azure.com"))
+            raise openai.BadRequestError("Too many inputs.", response=response, body=None)
+
+        def embed():
+            tokens = sum(count_tokens(text) for text in texts)
+            return SimpleNamespace(
+                data=[SimpleNamespace(index=i, embedding=fake_embedding(text)) for i, text in enumerate(texts)],
+                usage=SimpleNamespace(prompt_tokens=tokens, total_tokens=tokens),
+            )
+        return self.faults.call(embed, openai_error, self.per_input_latency * len(texts))
+
+# Chat
+
+def compose_answer(messages):
+    # Answers from the sources in the last message, ending with the keywords line the app
+    # expects. For the image filter prompt, returns the images whose names occur in the text.
+    content = messages[-1]["content"]
+    if "\nImage: " in content:
+        text, _, images = content.partition("\nImage: ")
+        names = [line.split(";")[0].replace("Image: ", "").strip() for line in ("Image: " + images).split("\n")]
+        words = set(re.findall(r"\w+", text.lower()))
+        return "\n".join(name for name in names
+                         if set(re.findall(r"[a-z]+", name.lower().rsplit(".", 1)[0])) & words)
+    sources = re.findall(r"Source: (\S+); Content: (.*?)(?= Source: |$)", content, flags=re.S)
+    if not sources:
+        return "I don't know.\nKeywords: History, University, Founders"
+    sentences = [f"{source_content.split('. ')[0].strip()} [{source_id}]." for source_id, source_content in sources[:3]]
+    names = re.findall(r"\b[A-Z][a-z]+(?: [A-Z][a-z]+)+", " ".join(c for _, c in sources))
+    keywords = list(dict.fromkeys(names))[:3] or ["History", "University", "Founders"]
+    return " ".join(sentences) + "\nKeywords: " + ", ".join(keywords)
+
+def completion(text, prompt_tokens):
+    return SimpleNamespace(
+        choices=[SimpleNamespace(message=SimpleNamespace(role="assistant", content=text), finish_reason="stop")],
+        usage=SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=count_tokens(text),
+                              total_tokens=prompt_tokens + count_tokens(text)),
+    )
+
+def chunk(text):
+    return SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=text), finish_reason=None)])
+
+class FakeCompletions:
+    def __init__(self, faults, token_latency=0.0):
+        self.faults = faults
+        self.token_latency = token_latency   # per generated token
+
+    def create(self, model, messages, stream=False, **kwargs):
+        prompt_tokens = sum(count_tokens(message["content"]) + 4 for message in messages) + 2
+        text = compose_answer(messages)
+        pieces = re.findall(r"\S+\s*|\s+", text)
+        if stream:
+            def generate():
+                for piece in pieces:
+                    if self.token_latency:
+                        time.sleep(self.token_latency)
+                    yield chunk(piece)
+            # The call returns once the first token is ready, the rest arrives while iterating
+            return self.faults.call(generate, openai_error)
+        return self.faults.call(lambda: completion(text, prompt_tokens), openai_error,
+                                self.token_latency * len(pieces))
+
+class FakeAzureOpenAI:
+    def __init__(self, embedding_faults=None, chat_faults=None, token_latency=0.0):
+        self.embeddings = FakeEmbeddings(embedding_faults or Faults())
+        self.chat = SimpleNamespace(completions=FakeCompletions(chat_faults or Faults(), token_latency))
+
+# Search
+
+def search_error(status):
+    error = HttpResponseError(message=f"Operation returned an invalid status code ({status})")
+    error.status_code = status
+    return error
+
+class FakeSearchClient:
+    def __init__(self, client, faults, per_document_latency=0.0002):
+        self.client = client
+        self.faults = faults
+        self.per_document_latency = per_document_latency
+
+    def search(self, *args, **kwargs):
+        return self.faults.call(lambda: list(self.client.search(*args, **kwargs)), search_error)
+
+    def get_document(self, *args, **kwargs):
+        return self.faults.call(lambda: self.client.get_document(*args, **kwargs), search_error)
+
+    def get_document_count(self):
+        return self.client.get_document_count()
+
+    def write(self, method, documents):
+        return self.faults.call(lambda: getattr(self.client, method)(documents=documents), search_error,
+                                self.per_document_latency * len(documents))
+
+    def upload_documents(self, documents, **kwargs):
+        return self.write("upload_documents", documents)
+
+    def merge_documents(self, documents, **kwargs):
+        return self.write("merge_documents", documents)
+
+    def merge_or_upload_documents(self, documents, **kwargs):
+        return self.write("merge_or_upload_documents", documents)
+
+    def delete_documents(self, documents, **kwargs):
+        return self.write("delete_documents", documents)
+
+class FakeSearchIndexClient:
+    def __init__(self, directory, faults=None):
+        self.client = LocalSearchIndexClient(directory)
+        self.faults = faults or Faults()
+
+    def create_or_update_index(self, index):
+        return self.client.create_or_update_index(index)
+
+    def get_index(self, name):
+        return self.client.get_index(name)
+
+    def delete_index(self, index):
+        return self.client.delete_index(index)
+
+    def get_search_client(self, index_name, **kwargs):
+        return FakeSearchClient(self.client.get_search_client(index_name), self.faults)
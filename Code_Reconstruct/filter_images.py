@@ -1,9 +1,26 @@
-from azure.core.credentials import AzureKeyCredential
-from azure.search.documents import SearchClient
-from azure.search.documents.indexes.models import *
-from azure.search.documents.models import VectorizedQuery
-import openai
-from openai import AzureOpenAI
+import os
+import re
+import csv
+from functools import lru_cache
+
+import tracing
+
+# "local" matches names and captions against the answer without a model call, "llm" asks the
+# chat model, "fallback" asks the chat model only when the local matcher keeps nothing
+image_filter_mode = os.getenv("IMAGE_FILTER_MODE", "local").lower()
+image_filter_threshold = float(os.getenv("IMAGE_FILTER_THRESHOLD", 0.5))
+image_csv_path = os.getenv(
+    "IMAGE_CSV_PATH", os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "outputupdated.csv")
+)
+
+# Titles are dropped from entities, the generic names are what every answer mentions anyway
+TITLES = {"dr", "sir", "mr", "mrs", "lady", "professor", "prof", "his", "her", "excellency", "the", "rector", "viceroy"}
+GENERIC = {"hku", "hong kong", "university", "the university", "university of hong kong", "college",
+           "the college", "main building", "china", "chinese", "college of medicine", "faculty of medicine",
+           "hong kong college of medicine", "university faculty of medicine"}
+STOPWORDS = {"the", "and", "for", "with", "from", "his", "her", "its", "was", "were", "are", "this", "that",
+             "who", "which", "later", "about", "one", "two", "first", "part", "photo", "image", "none",
+             "jpg", "png", "university", "hong", "kong", "college", "group", "building", "chinese"}
 
 def filter_images(openai_client, text, image_list):
 
@@ -23,10 +40,91 @@ def filter_images(openai_client, text, image_list):
         {'role' : 'system', 'content' : prompt + text + "".join(image_plus_caption)}
     ]   
 
-    response = openai_client.chat.completions.create(
-        model="summer",
-        messages=history,
-        temperature=0.7,
-    )
+    with tracing.span("filter_images_llm"):
+        response = openai_client.chat.completions.create(
+            model="summer",
+            messages=history,
+            temperature=0.7,
+        )
+        tracing.add(requests=1, prompt_tokens=response.usage.prompt_tokens, completion_tokens=response.usage.completion_tokens)
 
     return response.choices[0].message.content.split("\n")
+
+def normalize(text):
+    # Lowercase words only, so "Yat-sen", "Yat Sen" and "YatSen" all become "yat sen"
+    text = re.sub(r"['’]s\b", "", text)
+    text = re.sub(r"(?<=[a-z])(?=[A-Z])", " ", text)
+    return " ".join(re.findall(r"[a-z0-9]+", text.lower()))
+
+def title_from_filename(filename):
+    # "2.1-DrHoKai.png" -> "Dr Ho Kai"
+    name = os.path.splitext(filename)[0]
+    name = re.sub(r"^[\d.]+-", "", name)
+    name = re.sub(r"(?<=[a-z])(?=[A-Z])", " ", name)
+    return re.sub(r"[_\-.]+", " ", name).strip()
+
+def extract_entities(text, single_words=False):
+    # Runs of capitalised words, e.g. "Dr Sun Yat-sen" -> "sun yat sen", without titles.
+    # Single capitalised words are too often just the start of a sentence, unless asked for
+    entities = set()
+    for match in re.findall(r"[A-Z][\w'’-]*(?:\.?\s+(?:of\s+)?[A-Z][\w'’-]*)*", text):
+        words = normalize(match).split()
+        while words and words[0] in TITLES:
+            words = words[1:]
+        entity = " ".join(words)
+        if not entity or entity in GENERIC or entity.isdigit():
+            continue
+        if not any(len(word) >= 3 and word not in STOPWORDS for word in words):
+            continue
+        if len(words) > 1 or (single_words and len(entity) >= 4):
+            entities.add(entity)
+    return entities
+
+def image_terms(name, caption):
+    # (named entities, distinctive terms) of an image, from its filename and caption
+    caption = "" if caption == "None" else caption
+    title = title_from_filename(name)
+    entities = extract_entities(title, single_words=True) | extract_entities(caption)
+    terms = {word for word in normalize(f"{title} {caption}").split()
+             if len(word) >= 3 and word not in STOPWORDS and not word.isdigit()}
+    return entities, terms
+
+@lru_cache(maxsize=None)
+def load_image_index(csv_path=image_csv_path):
+    # Precomputed terms of every archive image, keyed by image name
+    index = {}
+    if os.path.exists(csv_path):
+        with open(csv_path, 'rt', newline='', encoding='utf-8', errors='ignore') as csvfile:
+            for item in csv.reader(csvfile):
+                index[item[0]] = image_terms(item[0], item[4])
+    return index
+
+def contains_phrase(text, phrase):
+    return f" {phrase} " in f" {text} "
+
+def score_image(normalized_text, name, caption):
+    # 1.0 when a named entity of the image is mentioned, otherwise the share of its terms mentioned
+    entities, terms = load_image_index().get(name) or image_terms(name, caption)
+    if any(contains_phrase(normalized_text, entity) for entity in entities):
+        return 1.0
+    if not terms:
+        return 0.0
+    words = set(normalized_text.split())
+    return len(terms & words) / len(terms)
+
+def filter_images_local(text, image_list, threshold=None):
+    # Same contract as filter_images: names of the images the text talks about
+    threshold = image_filter_threshold if threshold is None else threshold
+    # The keyword line is not part of the answer
+    answer = "\n".join(text.split("\n")[:-1]) if "\n" in text else text
+    normalized_text = normalize(answer)
+    return [name for name, caption in image_list if score_image(normalized_text, name, caption) >= threshold]
+
+def select_images(openai_client, text, image_list, mode=None):
+    mode = mode or image_filter_mode
+    if mode == "llm":
+        return filter_images(openai_client, text, image_list)
+    names = filter_images_local(text, image_list)
+    if not names and image_list and mode == "fallback":
+        return filter_images(openai_client, text, image_list)
+    return names
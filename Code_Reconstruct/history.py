@@ -0,0 +1,60 @@
+import os
+
+from tokenizer import count_tokens as count_text_tokens
+
+# Prompt budget for the conversation (system prompt, earlier turns and the new question with
+# its sources), and how many of the latest turns keep their source blocks
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", 6000))
+HISTORY_RECENT_TURNS = int(os.getenv("HISTORY_RECENT_TURNS", 1))
+
+def count_tokens(messages):
+    # Chat format overhead: ~4 tokens per message plus 2 to prime the reply
+    return sum(count_text_tokens(message["content"]) + 4 for message in messages) + 2
+
+class ConversationMemory:
+    # Replaces the ever-growing history_openai list: earlier turns are resent as question and
+    # answer only, the latest turns verbatim, and the oldest turns are dropped to fit the budget
+    def __init__(self, prefix, budget=HISTORY_TOKEN_BUDGET, recent_turns=HISTORY_RECENT_TURNS):
+        self.prefix = list(prefix)   # system prompt messages, always sent
+        self.budget = budget
+        self.recent_turns = recent_turns
+        self.turns = []              # {"query", "message" (query with sources), "answer"}
+        self.prompt_tokens = []      # tokens of the prompt sent for each turn
+
+    def turn_messages(self, turn, with_sources):
+        return [
+            {"role": "user", "content": turn["message"] if with_sources else turn["query"]},
+            {"role": "assistant", "content": turn["answer"]},
+        ]
+
+    def messages(self, chat_message):
+        # Prompt for the next turn, chat_message is the new question with its sources
+        turns = list(self.turns)
+        with_sources = [i >= len(turns) - self.recent_turns for i in range(len(turns))]
+
+        def build():
+            messages = list(self.prefix)
+            for turn, sources in zip(turns, with_sources):
+                messages += self.turn_messages(turn, sources)
+            return messages + [{"role": "user", "content": chat_message}]
+
+        messages = build()
+        # Strip sources from the recent turns first, then drop the oldest turns
+        for i in range(len(turns)):
+            if count_tokens(messages) <= self.budget:
+                break
+            if with_sources[i]:
+                with_sources[i] = False
+                messages = build()
+        while turns and count_tokens(messages) > self.budget:
+            turns.pop(0)
+            with_sources.pop(0)
+            messages = build()
+        self.prompt_tokens.append(count_tokens(messages))
+        return messages
+
+    def add_turn(self, query, chat_message, answer, cached=False):
+        # A cached answer was not generated, so no prompt was sent for it
+        if cached:
+            self.prompt_tokens.append(0)
+        self.turns.append({"query": query, "message": chat_message, "answer": answer})
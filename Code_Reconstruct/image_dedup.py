@@ -0,0 +1,169 @@
+import os
+import re
+import sys
+import csv
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from scipy.fft import dctn
+from PIL import Image
+
+# Near-duplicate archive images (the same photo as .png and .jpg, prefixed and unprefixed
+# copies, a cropped photo and the scan of its album page) found by 64-bit perceptual hash.
+# The mat, frame and caption label around a photo are trimmed first, and each image is hashed
+# whole and as central crops, so a tighter crop of the same photo still lines up. Images with
+# a pair of hashes within DEDUP_THRESHOLD differing bits are one cluster, and only its
+# canonical image is captioned, indexed and shown. On jpg/ the copies are within 10 bits and
+# other photos 16 or more apart, only consecutive takes of one group photo (The Old Hallites)
+# are as close as copies and are grouped as well.
+#   python image_dedup.py [image_dir]   lists the duplicates and the copy each one maps to
+IMAGE_DIR = os.getenv("IMAGE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "jpg"))
+DEDUP_THRESHOLD = int(os.getenv("DEDUP_THRESHOLD", 10))
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".tif", ".webp")
+HASH_SIZE = 256              # pixels on the long side the border is trimmed at
+HASH_CROPS = (1.0, 0.9, 0.8) # central crops hashed, as a share of the trimmed width and height
+BORDER_STD = 8.0             # rows or columns with less grayscale deviation are mat or frame
+
+def largest_block(uniform):
+    # (start, end) of the longest run of non-uniform rows
+    best, start = (0, 0), None
+    for i, flat in enumerate(list(uniform) + [True]):
+        if not flat and start is None:
+            start = i
+        elif flat and start is not None:
+            best = max(best, (start, i), key=lambda run: run[1] - run[0])
+            start = None
+    return best
+
+def trim_border(pixels, min_share=0.3):
+    # Keeps the largest block between uniform rows and columns, e.g. the photo on an album page
+    # without the mat around it and the caption label below it
+    for _ in range(4):
+        height, width = pixels.shape
+        top, bottom = largest_block(pixels.std(axis=1) < BORDER_STD)
+        left, right = largest_block(pixels.std(axis=0) < BORDER_STD)
+        if bottom - top < min_share * height or right - left < min_share * width:
+            break
+        if (top, bottom, left, right) == (0, height, 0, width):
+            break
+        pixels = pixels[top:bottom, left:right]
+    return pixels
+
+def dct_hash(pixels):
+    # pHash: 32x32 grayscale, 2D DCT, signs of the 8x8 lowest frequencies against their median
+    small = Image.fromarray(pixels.astype(np.uint8)).resize((32, 32), Image.LANCZOS)
+    low = dctn(np.asarray(small, dtype=np.float64), norm="ortho")[:8, :8].flatten()
+    bits = low > np.median(low[1:])
+    return int("".join("1" if bit else "0" for bit in bits), 2)
+
+def perceptual_hash(path):
+    # Returns (hashes of the HASH_CROPS, width, height)
+    with Image.open(path) as img:
+        size = img.size # before draft, which shrinks the reported size of a JPEG
+        img.draft("L", (HASH_SIZE, HASH_SIZE))
+        img = img.convert("L")
+        img.thumbnail((HASH_SIZE, HASH_SIZE))
+        pixels = trim_border(np.asarray(img, dtype=np.float64))
+    height, width = pixels.shape
+    hashes = []
+    for share in HASH_CROPS:
+        dy, dx = int(height * (1 - share) / 2), int(width * (1 - share) / 2)
+        hashes.append(dct_hash(pixels[dy:height - dy, dx:width - dx]))
+    return tuple(hashes), size[0], size[1]
+
+def distance(a, b):
+    return bin(a ^ b).count("1")
+
+class BKTree:
+    # Metric tree over Hamming distance: a radius query only visits children whose edge
+    # distance is within radius of the query's distance to the node
+    def __init__(self):
+        self.root = None   # [hash, items, {distance: child}]
+
+    def add(self, value, item):
+        if self.root is None:
+            self.root = [value, [item], {}]
+            return
+        node = self.root
+        while True:
+            d = distance(value, node[0])
+            if d == 0:
+                node[1].append(item)
+                return
+            if d not in node[2]:
+                node[2][d] = [value, [item], {}]
+                return
+            node = node[2][d]
+
+    def search(self, value, radius):
+        found = []
+        stack = [self.root] if self.root else []
+        while stack:
+            node = stack.pop()
+            d = distance(value, node[0])
+            if d <= radius:
+                found += node[1]
+            stack += [child for edge, child in node[2].items() if d - radius <= edge <= d + radius]
+        return found
+
+def canonical(names, info, preferred=()):
+    # Keep the copy the captions refer to, else the largest, else the one without a "2.1-" style prefix
+    def rank(name):
+        _, width, height = info[name]
+        return (name in preferred, width * height, not re.match(r"^[\d.]+-", name), -len(name), name)
+    return max(names, key=rank)
+
+def find_duplicates(image_dir=IMAGE_DIR, threshold=DEDUP_THRESHOLD, preferred=(), workers=None):
+    # {duplicate name: canonical name} for every image that is not the canonical copy of its cluster
+    names = sorted(name for name in os.listdir(image_dir) if name.lower().endswith(IMAGE_EXTENSIONS))
+    # Threads: decoding and the DCT release the GIL, and the update scripts that call this have
+    # no __main__ guard for process workers to re-import under spawn
+    with ThreadPoolExecutor(max_workers=workers or min(32, (os.cpu_count() or 1) + 4)) as executor:
+        info = dict(zip(names, executor.map(perceptual_hash, [os.path.join(image_dir, n) for n in names])))
+
+    tree = BKTree()
+    for name in names:
+        for value in info[name][0]:
+            tree.add(value, name)
+    # Union-find over all pairs with a crop hash within the threshold
+    parent = {name: name for name in names}
+    def find(name):
+        while parent[name] != name:
+            parent[name] = parent[parent[name]]
+            name = parent[name]
+        return name
+    for name in names:
+        for value in info[name][0]:
+            for other in tree.search(value, threshold):
+                parent[find(other)] = find(name)
+    clusters = {}
+    for name in names:
+        clusters.setdefault(find(name), []).append(name)
+
+    duplicates = {}
+    for members in clusters.values():
+        if len(members) > 1:
+            keep = canonical(members, info, preferred)
+            duplicates.update({name: keep for name in members if name != keep})
+    return duplicates
+
+def unique_rows(rows, duplicates):
+    # CSV rows (image name first) without the duplicates, so their documents leave the index
+    for row in rows:
+        if row and row[0] in duplicates:
+            continue
+        yield row
+
+def caption_names(csv_path):
+    # Images that already have a caption are kept over their copies
+    with open(csv_path, 'rt', newline='', encoding='utf-8', errors='ignore') as csvfile:
+        return {row[0] for row in csv.reader(csvfile) if row}
+
+if __name__ == "__main__":
+    image_dir = sys.argv[1] if len(sys.argv) > 1 else IMAGE_DIR
+    csv_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "outputupdated.csv")
+    preferred = caption_names(csv_path) if os.path.exists(csv_path) else set()
+    duplicates = find_duplicates(image_dir, preferred=preferred)
+    for name, keep in sorted(duplicates.items(), key=lambda item: item[1]):
+        print(f"{name} -> {keep}")
+    total = len([n for n in os.listdir(image_dir) if n.lower().endswith(IMAGE_EXTENSIONS)])
+    print(f"{len(duplicates)} duplicates of {total} images, {total - len(duplicates)} kept")
@@ -0,0 +1,82 @@
+import os
+import json
+import numpy as np
+
+from section_index import SectionIndex
+
+# Paragraph id -> the top IMAGE_LINKS_TOP_K archive images by cosine similarity of their
+# embeddings, built once after ingestion so the app gets candidate images from the retrieved
+# paragraphs without embedding the answer keywords and searching the image index again.
+# Vectors come through get_embeddings, i.e. from the embedding cache filled during ingestion.
+DEFAULT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".image_links")
+IMAGE_LINKS_TOP_K = int(os.getenv("IMAGE_LINKS_TOP_K", 5))
+IMAGE_LINKS_BLOCK = 1024 # paragraphs per matrix product, bounds the score matrix in memory
+
+def links_path(text_index_name, directory=DEFAULT_DIR):
+    return os.path.join(directory, f"{text_index_name}.json")
+
+def unit_rows(vectors):
+    matrix = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.where(norms == 0, 1, norms)
+
+def top_images(paragraph_vectors, image_vectors, k=IMAGE_LINKS_TOP_K, block=IMAGE_LINKS_BLOCK):
+    # [(image positions, scores)] per paragraph, best first
+    k = min(k, len(image_vectors))
+    results = []
+    for start in range(0, len(paragraph_vectors), block):
+        scores = paragraph_vectors[start:start + block] @ image_vectors.T
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        results += zip(np.take_along_axis(top, order, axis=1), np.take_along_axis(top_scores, order, axis=1))
+    return results
+
+def build_image_links(text_index_name, image_csv_path, get_embeddings, duplicates=None, k=IMAGE_LINKS_TOP_K,
+                      directory=DEFAULT_DIR):
+    # Paragraphs from the section index written by ingest, images from the caption CSV.
+    # Imported here, the pipeline only reads the links and should not load PIL, scipy or openai
+    from image_dedup import unique_rows
+    from ingest import read_csv
+    from schemas import IMAGE
+    paragraphs = [(doc_id, content) for section in SectionIndex(text_index_name).sections.values()
+                  for doc_id, content in section]
+    images = [IMAGE.document(row) for row in unique_rows(read_csv(image_csv_path), duplicates or {})]
+    links = {}
+    if paragraphs and images:
+        paragraph_vectors = unit_rows(get_embeddings([content for _, content in paragraphs]))
+        image_vectors = unit_rows(get_embeddings([IMAGE.embedding_text(image) for image in images]))
+        for (doc_id, _), (positions, scores) in zip(paragraphs, top_images(paragraph_vectors, image_vectors, k)):
+            links[doc_id] = [[images[p]["Image_name"], images[p]["Caption"], round(float(s), 4)]
+                             for p, s in zip(positions, scores)]
+
+    path = links_path(text_index_name, directory)
+    os.makedirs(directory, exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(links, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+    print(f"Image links: {len(paragraphs)} paragraphs x {len(images)} images, top {k} kept")
+    return links
+
+class ImageLinks:
+    def __init__(self, text_index_names, directory=DEFAULT_DIR):
+        text_index_names = [text_index_names] if isinstance(text_index_names, str) else text_index_names
+        self.links = {}
+        for text_index_name in text_index_names:
+            path = links_path(text_index_name, directory)
+            if os.path.exists(path):
+                with open(path, encoding="utf-8") as f:
+                    self.links.update(json.load(f))
+
+    def __bool__(self):
+        return bool(self.links)
+
+    def images(self, doc_ids, top=5):
+        # [(name, caption, score)] linked to any of the paragraphs, each image at its best score
+        best = {}
+        for doc_id in doc_ids:
+            for name, caption, score in self.links.get(doc_id, []):
+                if name not in best or score > best[name][2]:
+                    best[name] = (name, caption, score)
+        return sorted(best.values(), key=lambda image: -image[2])[:top]
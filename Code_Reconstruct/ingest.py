@@ -0,0 +1,189 @@
+import os
+import csv
+import time
+import queue
+import threading
+import numpy as np
+
+from bulk_upload import send_batch, iter_batches, ACTIONS, MAX_RETRIES, MAX_BATCH_DOCS, MAX_BATCH_BYTES
+from embeddings import MAX_BATCH_ITEMS
+from manifest import Manifest, content_hash, index_keys
+from schemas import VECTOR_FIELD
+from section_index import save_section_index
+
+# Streaming ingestion: rows are read, turned into documents, embedded and uploaded batch by
+# batch. The stages run in their own threads connected by bounded queues, so embedding of
+# one batch overlaps the upload of the previous one, and a slow stage blocks the ones before
+# it instead of letting batches pile up. Embedded documents are repacked into upload batches
+# bounded like bulk_upload's (UPLOAD_BATCH_DOCS, UPLOAD_BATCH_BYTES), whatever the embedding
+# batch size. Memory holds at most about (INGEST_QUEUE_BATCHES + workers) batches of each
+# kind, whatever the size of the source. Only the manifest (key -> hash) and, for book
+# paragraphs, the section index grow with it.
+INGEST_BATCH_DOCS = int(os.getenv("INGEST_BATCH_DOCS", MAX_BATCH_ITEMS))
+INGEST_QUEUE_BATCHES = int(os.getenv("INGEST_QUEUE_BATCHES", 4))
+INGEST_EMBED_WORKERS = int(os.getenv("INGEST_EMBED_WORKERS", 2))
+INGEST_UPLOAD_WORKERS = int(os.getenv("INGEST_UPLOAD_WORKERS", 2))
+
+def read_csv(path, skip_header=True):
+    with open(path, 'rt', newline='', encoding='utf-8', errors='ignore') as csvfile:
+        csvreader = csv.reader(csvfile)
+        if skip_header:
+            next(csvreader, None)
+        yield from csvreader
+
+class IngestReport:
+    def __init__(self, index_name, source_name):
+        self.index_name = index_name
+        self.source_name = source_name
+        self.rows = 0
+        self.unchanged = 0
+        self.changed = 0
+        self.uploaded = 0
+        self.deleted = 0
+        self.failed = {}   # key -> reason
+        self.batches = 0
+        self.bytes = 0     # serialized size of the uploaded batches
+        self.requests = 0
+        self.retries = 0
+        self.seconds = 0.0
+        self.lock = threading.Lock()
+
+    @property
+    def docs_per_second(self):
+        return self.changed / self.seconds if self.seconds else 0.0
+
+    @property
+    def mb_per_second(self):
+        return self.bytes / 1024 / 1024 / self.seconds if self.seconds else 0.0
+
+    def summary(self):
+        return (f"{self.index_name} <- {self.source_name}: {self.rows} rows, {self.changed} new or changed "
+                f"({self.uploaded} uploaded, {len(self.failed)} failed), {self.unchanged} unchanged, "
+                f"{self.deleted} removed in {self.seconds:.1f}s ({self.docs_per_second:.1f} docs/s, "
+                f"{self.bytes / 1024 / 1024:.1f} MB in {self.requests} requests, {self.mb_per_second:.2f} MB/s)")
+
+def ingest(schema, rows, search_client, index_name, source_name, get_embeddings, model, full=False,
+           sole_source=False, batch_docs=INGEST_BATCH_DOCS, queue_batches=INGEST_QUEUE_BATCHES,
+           embed_workers=INGEST_EMBED_WORKERS, upload_workers=INGEST_UPLOAD_WORKERS,
+           upload_docs=MAX_BATCH_DOCS, upload_bytes=MAX_BATCH_BYTES):
+    # rows: any iterable of source rows, e.g. read_csv(path). Only rows whose content hash
+    # differs from the manifest are embedded and uploaded (all with full=True) and keys that
+    # are no longer in the source are deleted. With sole_source=True the source is all the
+    # index holds: on a full run or without a manifest (e.g. the image index from before keys
+    # were derived from Image_name), keys are diffed against the index itself, so documents
+    # under stale keys are deleted too.
+    report = IngestReport(index_name, source_name)
+    manifest = Manifest(index_name, source_name)
+    embed_queue = queue.Queue(maxsize=queue_batches)
+    embedded_queue = queue.Queue(maxsize=queue_batches)
+    upload_queue = queue.Queue(maxsize=queue_batches)
+    digests = {}   # key -> content hash of the documents on their way to the index
+    start = time.perf_counter()
+
+    def fail(documents, reason):
+        with report.lock:
+            report.failed.update({document["id"]: reason for document in documents})
+
+    def embed_stage():
+        while (batch := embed_queue.get()) is not None:
+            try:
+                vectors = get_embeddings([text for _, text in batch])
+            except Exception as e:
+                fail([document for document, _ in batch], f"embedding: {e}")
+                continue
+            for (document, _), vector in zip(batch, vectors):
+                document[VECTOR_FIELD] = vector
+            embedded_queue.put([document for document, _ in batch])
+
+    def embedded_documents():
+        # Vectors stay arrays until a document is packed for upload, which sends JSON
+        while (documents := embedded_queue.get()) is not None:
+            for document in documents:
+                document[VECTOR_FIELD] = np.asarray(document[VECTOR_FIELD], dtype=np.float32).tolist()
+                yield document
+
+    def pack_stage():
+        for batch in iter_batches(embedded_documents(), upload_docs, upload_bytes):
+            upload_queue.put(batch)
+
+    def upload_stage():
+        method = ACTIONS["mergeOrUpload"]
+        while (item := upload_queue.get()) is not None:
+            batch, batch_bytes = item
+            try:
+                succeeded, failed, requests, retries = send_batch(search_client, method, batch, "id", MAX_RETRIES)
+            except Exception as e:
+                fail(batch, f"upload: {e}")
+                continue
+            with report.lock:
+                for key in succeeded:
+                    manifest.entries[key] = digests[key]
+                report.uploaded += len(succeeded)
+                report.failed.update(failed)
+                report.batches += 1
+                report.bytes += batch_bytes
+                report.requests += requests
+                report.retries += retries
+
+    embedders = [threading.Thread(target=embed_stage, daemon=True) for _ in range(max(1, embed_workers))]
+    packer = threading.Thread(target=pack_stage, daemon=True)
+    uploaders = [threading.Thread(target=upload_stage, daemon=True) for _ in range(max(1, upload_workers))]
+    for thread in embedders + [packer] + uploaders:
+        thread.start()
+
+    seen = set()
+    sections = []
+    batch = []
+    try:
+        for row in rows:
+            document = schema.document(row)
+            text = schema.embedding_text(document)
+            digest = content_hash(document, text, model)
+            report.rows += 1
+            seen.add(document["id"])
+            if schema.sections:
+                sections.append(dict(document))
+            if not full and manifest.entries.get(document["id"]) == digest:
+                report.unchanged += 1
+                continue
+            report.changed += 1
+            digests[document["id"]] = digest
+            batch.append((document, text))
+            if len(batch) >= batch_docs:
+                embed_queue.put(batch) # blocks while the embedders are behind
+                batch = []
+        if batch:
+            embed_queue.put(batch)
+    finally:
+        for _ in embedders:
+            embed_queue.put(None)
+        for thread in embedders:
+            thread.join()
+        embedded_queue.put(None)
+        packer.join()
+        for _ in uploaders:
+            upload_queue.put(None)
+        for thread in uploaders:
+            thread.join()
+
+    deleted = [key for key in manifest.entries if key not in seen]
+    if sole_source and (full or not manifest.loaded):
+        stale = index_keys(search_client, schema.key_fields) - seen
+        deleted += [key for key in stale if key not in manifest.entries]
+    for batch, _ in iter_batches([{"id": key} for key in deleted], upload_docs, upload_bytes):
+        succeeded, failed, requests, _ = send_batch(search_client, ACTIONS["delete"], batch, "id", MAX_RETRIES)
+        report.requests += requests
+        for key in succeeded:
+            manifest.entries.pop(key, None)
+        report.deleted += len(succeeded)
+        report.failed.update(failed)
+
+    manifest.save()
+    if schema.sections:
+        # Paragraph order of every section, used by the app to expand hits without extra requests
+        save_section_index(index_name, source_name, sections)
+    report.seconds = time.perf_counter() - start
+    print(report.summary())
+    for key, reason in report.failed.items():
+        print(f"  failed {key}: {reason}")
+    return report
@@ -0,0 +1,373 @@
+import os
+import re
+import json
+import shutil
+import threading
+import contextlib
+import numpy as np
+from azure.core.exceptions import ResourceNotFoundError
+
+from quantize import quantize, dequantize, scores as quantized_scores
+
+# In-process stand-in for the Azure AI Search clients built in setup.py. Each index is a folder
+# with the documents (without vectors) in documents.json and the L2-normalized float32 vectors
+# in embeddings.npy, which is memory-mapped on load. Vector search is exact top-k unless the
+# index is large enough for the approximate (IVF) index to pay off. Vectors are written as
+# LOCAL_SEARCH_VECTOR_DTYPE (float16 by default, int8 adds scales.npy, see quantize.py),
+# indexes written with another dtype are read as they are. Every request first checks whether
+# documents.json was replaced since the load, so the app picks up a re-ingested index. Writes
+# hold an exclusive lock on <index>.lock for the whole read-modify-write and loads a shared
+# one, so processes neither lose each other's writes nor read half-replaced files.
+DEFAULT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".local_index")
+APPROXIMATE_MIN_DOCS = int(os.getenv("LOCAL_SEARCH_APPROXIMATE_MIN_DOCS", 50000))
+VECTOR_DTYPE = os.getenv("LOCAL_SEARCH_VECTOR_DTYPE", "float16").lower()
+
+class IndexingResult:
+    # Same attributes as azure.search.documents.models.IndexingResult
+    def __init__(self, key, succeeded, status_code, error_message=None):
+        self.key = key
+        self.succeeded = succeeded
+        self.status_code = status_code
+        self.error_message = error_message
+
+def normalize(matrix):
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.where(norms == 0, 1, norms)
+
+def cosine_to_score(similarity):
+    # Azure reports 1 / (1 + cosine distance) as @search.score for the cosine metric
+    return 1.0 / (2.0 - similarity)
+
+def top_k(scores, k):
+    # Row-wise top-k of a (queries, docs) score matrix, best first
+    k = min(k, scores.shape[1])
+    if k == 0:
+        return np.empty((scores.shape[0], 0), dtype=np.int64)
+    if k < scores.shape[1]:
+        idx = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        idx = np.tile(np.arange(scores.shape[1]), (scores.shape[0], 1))
+    order = np.argsort(-np.take_along_axis(scores, idx, axis=1), axis=1, kind="stable")
+    return np.take_along_axis(idx, order, axis=1)
+
+class IVFIndex:
+    # Inverted-file approximate index: k-means coarse quantizer, search probes the closest lists
+    def __init__(self, matrix, n_lists=None, n_probe=8, iterations=10, seed=0):
+        n = matrix.shape[0]
+        self.n_lists = n_lists or max(1, int(np.sqrt(n)))
+        self.n_probe = min(n_probe, self.n_lists)
+        rng = np.random.default_rng(seed)
+        centroids = matrix[rng.choice(n, self.n_lists, replace=False)].astype(np.float32)
+        for _ in range(iterations):
+            assignment = np.argmax(matrix @ centroids.T, axis=1)
+            for c in range(self.n_lists):
+                members = matrix[assignment == c]
+                if len(members):
+                    centroids[c] = members.mean(axis=0)
+            centroids = normalize(centroids)
+        self.centroids = centroids
+        assignment = np.argmax(matrix @ centroids.T, axis=1)
+        self.lists = [np.flatnonzero(assignment == c) for c in range(self.n_lists)]
+
+    def search(self, matrix, queries, k, scales=None):
+        probes = top_k(queries @ self.centroids.T, self.n_probe)
+        results = []
+        for query, lists in zip(queries, probes):
+            candidates = np.concatenate([self.lists[c] for c in lists])
+            scores = quantized_scores(query[None, :], matrix, scales, candidates)[0]
+            best = top_k(scores[None, :], k)[0]
+            results.append((candidates[best], scores[best]))
+        return results
+
+@contextlib.contextmanager
+def file_lock(path, shared=False):
+    # Advisory lock across processes, shared for readers where the platform has it
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "a+b") as f:
+        try:
+            import fcntl
+        except ImportError: # Windows, exclusive only
+            import msvcrt
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+            return
+        fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+class LocalSearchClient:
+    def __init__(self, index_name, directory=DEFAULT_DIR, key_field="id", vector_field="Embedding",
+                 approximate=None, dtype=VECTOR_DTYPE):
+        self.index_name = index_name
+        self.path = os.path.join(directory, index_name)
+        self.lock_path = self.path + ".lock"
+        self.key_field = key_field
+        self.vector_field = vector_field
+        self.approximate = approximate # None: decide by corpus size
+        self.dtype = dtype
+        self.lock = threading.RLock()
+        self.ivf = None
+        with file_lock(self.lock_path, shared=True):
+            self.load()
+
+    def file_version(self):
+        # documents.json is replaced last by save(), a new one means the whole index was rewritten
+        try:
+            stat = os.stat(os.path.join(self.path, "documents.json"))
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def refresh(self):
+        # Another process (an update script) may have re-ingested the index since it was loaded
+        if self.file_version() != self.version:
+            with self.lock, file_lock(self.lock_path, shared=True):
+                if self.file_version() != self.version:
+                    self.load()
+
+    def load(self):
+        # The caller holds the file lock
+        documents_path = os.path.join(self.path, "documents.json")
+        embeddings_path = os.path.join(self.path, "embeddings.npy")
+        scales_path = os.path.join(self.path, "scales.npy")
+        self.version = self.file_version()
+        self.scales = None
+        if os.path.exists(documents_path):
+            with open(documents_path, encoding="utf-8") as f:
+                self.documents = json.load(f)
+            self.matrix = np.load(embeddings_path, mmap_mode="r")
+            if self.matrix.dtype == np.int8:
+                self.scales = np.load(scales_path)
+        else:
+            self.documents = []
+            self.matrix = np.zeros((0, 0), dtype=np.float32)
+        self.rows = {document[self.key_field]: i for i, document in enumerate(self.documents)}
+        self.ivf = None
+
+    def save(self):
+        # The caller holds the exclusive file lock
+        os.makedirs(self.path, exist_ok=True)
+        tmp_documents = os.path.join(self.path, "documents.json.tmp")
+        tmp_embeddings = os.path.join(self.path, "embeddings.tmp.npy")
+        with open(tmp_documents, "w", encoding="utf-8") as f:
+            json.dump(self.documents, f, ensure_ascii=False)
+        codes, scales = quantize(self.vectors(), self.dtype)
+        np.save(tmp_embeddings, np.ascontiguousarray(codes))
+        if scales is not None:
+            tmp_scales = os.path.join(self.path, "scales.tmp.npy")
+            np.save(tmp_scales, scales)
+            os.replace(tmp_scales, os.path.join(self.path, "scales.npy"))
+        os.replace(tmp_embeddings, os.path.join(self.path, "embeddings.npy"))
+        os.replace(tmp_documents, os.path.join(self.path, "documents.json"))
+        self.load()
+
+    def vectors(self, rows=None):
+        # float32 vectors of the given rows (all by default)
+        rows = slice(None) if rows is None else rows
+        return dequantize(self.matrix[rows], None if self.scales is None else self.scales[rows])
+
+    # Queries
+
+    def get_document_count(self):
+        self.refresh()
+        return len(self.documents)
+
+    def get_document(self, key, selected_fields=None, **kwargs):
+        self.refresh()
+        row = self.rows.get(key)
+        if row is None:
+            raise ResourceNotFoundError(f"Document '{key}' not found in local index '{self.index_name}'")
+        return self.result(row, selected_fields)
+
+    def result(self, row, select=None, score=None):
+        document = dict(self.documents[row])
+        if select:
+            if "*" not in select:
+                document = {name: value for name, value in document.items() if name in select}
+            if "*" in select or self.vector_field in select:
+                document[self.vector_field] = self.vectors([row])[0].tolist()
+        if score is not None:
+            document["@search.score"] = float(score)
+        return document
+
+    def search(self, search_text=None, top=None, vector_queries=None, filter=None, select=None, skip=0,
+               order_by=None, **kwargs):
+        self.refresh()
+        top = 50 if top is None else top
+        skip = skip or 0
+        rows = self.filter_rows(filter)
+        if vector_queries:
+            queries = normalize([query.vector for query in vector_queries])
+            best = {}
+            for results in self.vector_search(queries, skip + top, rows):
+                for row, similarity in results:
+                    best[row] = max(best.get(row, -1.0), similarity)
+            ranked = sorted(best.items(), key=lambda item: -item[1])[skip:skip + top]
+            return [self.result(row, select, cosine_to_score(similarity)) for row, similarity in ranked]
+        if search_text and search_text != "*":
+            return self.text_search(search_text, skip + top, rows, select)[skip:]
+        rows = range(len(self.documents)) if rows is None else rows
+        return [self.result(row, select, 1.0) for row in self.order_rows(rows, order_by)[skip:skip + top]]
+
+    def order_rows(self, rows, order_by):
+        # "field" or "field desc" clauses, the first one sorts first
+        rows = list(rows)
+        for clause in reversed(order_by or []):
+            field, _, direction = clause.partition(" ")
+            rows.sort(key=lambda row: str(self.documents[row].get(field, "")), reverse=direction.strip() == "desc")
+        return rows
+
+    def search_many(self, vectors, top=5):
+        # Batched exact/approximate top-k for several query vectors, one result list per vector
+        self.refresh()
+        queries = normalize(vectors)
+        return [
+            [self.result(row, None, cosine_to_score(similarity)) for row, similarity in results]
+            for results in self.vector_search(queries, top)
+        ]
+
+    def vector_search(self, queries, k, rows=None):
+        with self.lock:
+            matrix, scales = self.matrix, self.scales
+            if len(self.documents) == 0:
+                return [[] for _ in queries]
+            if rows is None and self.use_approximate():
+                if self.ivf is None:
+                    self.ivf = IVFIndex(self.vectors())
+                return [list(zip(idx.tolist(), scores.tolist()))
+                        for idx, scores in self.ivf.search(matrix, queries, k, scales)]
+        candidates = np.arange(matrix.shape[0]) if rows is None else np.asarray(rows, dtype=np.int64)
+        scores = quantized_scores(queries, matrix, scales, candidates)
+        best = top_k(scores, k)
+        return [
+            list(zip(candidates[idx].tolist(), np.take(row_scores, idx).tolist()))
+            for idx, row_scores in zip(best, scores)
+        ]
+
+    def use_approximate(self):
+        if self.approximate is None:
+            return len(self.documents) >= APPROXIMATE_MIN_DOCS
+        return self.approximate
+
+    def text_search(self, search_text, top, rows, select):
+        terms = re.findall(r"\w+", search_text.lower())
+        rows = range(len(self.documents)) if rows is None else rows
+        scored = []
+        for row in rows:
+            text = " ".join(str(value) for value in self.documents[row].values()).lower()
+            score = sum(text.count(term) for term in terms)
+            if score:
+                scored.append((row, score))
+        scored.sort(key=lambda item: -item[1])
+        return [self.result(row, select, score) for row, score in scored[:top]]
+
+    def filter_rows(self, filter):
+        # Supports the OData subset the app uses: search.in(field, 'a,b', ',') and field eq 'value',
+        # optionally joined with "and"
+        if not filter:
+            return None
+        rows = set(range(len(self.documents)))
+        for clause in re.split(r"\s+and\s+", filter.strip()):
+            match_in = re.fullmatch(r"search\.in\(\s*(\w+)\s*,\s*'([^']*)'\s*(?:,\s*'([^']*)'\s*)?\)", clause)
+            match_eq = re.fullmatch(r"(\w+)\s+eq\s+'([^']*)'", clause)
+            if match_in:
+                field, values, delimiter = match_in.groups()
+                allowed = set(values.split(delimiter or ","))
+            elif match_eq:
+                field, value = match_eq.groups()
+                allowed = {value}
+            else:
+                raise ValueError(f"Unsupported filter for the local search backend: {clause}")
+            rows = {row for row in rows if str(self.documents[row].get(field)) in allowed}
+        return sorted(rows)
+
+    # Writes
+
+    def upload_documents(self, documents, **kwargs):
+        return self.write(documents, merge=False)
+
+    def merge_or_upload_documents(self, documents, **kwargs):
+        return self.write(documents, merge=True)
+
+    def merge_documents(self, documents, **kwargs):
+        return self.write(documents, merge=True, missing_ok=False)
+
+    @contextlib.contextmanager
+    def writing(self):
+        # Exclusive for the whole read-modify-write, starting from what is on disk now
+        with self.lock, file_lock(self.lock_path):
+            if self.file_version() != self.version:
+                self.load()
+            yield
+
+    def write(self, documents, merge, missing_ok=True):
+        with self.writing():
+            results = []
+            if not missing_ok:
+                results = [IndexingResult(d[self.key_field], False, 404, "Document not found")
+                           for d in documents if d[self.key_field] not in self.rows]
+                documents = [d for d in documents if d[self.key_field] in self.rows]
+            stored = list(self.documents)
+            vectors = list(self.vectors()) if stored else []
+            rows = dict(self.rows)
+            for document in documents:
+                key = document[self.key_field]
+                fields = {name: value for name, value in document.items() if name != self.vector_field}
+                vector = document.get(self.vector_field)
+                row = rows.get(key)
+                if row is None:
+                    if vector is None:
+                        results.append(IndexingResult(key, False, 400, "Missing vector field"))
+                        continue
+                    rows[key] = len(stored)
+                    stored.append(fields)
+                    vectors.append(normalize(vector))
+                    results.append(IndexingResult(key, True, 201))
+                else:
+                    stored[row] = {**stored[row], **fields} if merge else fields
+                    if vector is not None:
+                        vectors[row] = normalize(vector)
+                    results.append(IndexingResult(key, True, 200))
+            self.documents = stored
+            self.matrix = np.vstack(vectors) if vectors else np.zeros((0, 0), dtype=np.float32)
+            self.scales = None
+            self.save()
+        return results
+
+    def delete_documents(self, documents, **kwargs):
+        with self.writing():
+            keys = {document[self.key_field] for document in documents}
+            keep = [i for i, document in enumerate(self.documents) if document[self.key_field] not in keys]
+            self.matrix = self.vectors(keep) if len(self.documents) else self.matrix
+            self.scales = None
+            self.documents = [self.documents[i] for i in keep]
+            self.save()
+        # Azure also reports success when deleting a key that does not exist
+        return [IndexingResult(key, True, 200) for key in keys]
+
+class LocalSearchIndexClient:
+    # Stand-in for SearchIndexClient, an index is just a folder under directory
+    def __init__(self, directory=DEFAULT_DIR):
+        self.directory = directory
+
+    def create_or_update_index(self, index):
+        os.makedirs(os.path.join(self.directory, index.name), exist_ok=True)
+        return index
+
+    def get_index(self, name):
+        # Definitions are not kept, the folder takes any fields
+        raise ResourceNotFoundError(f"Local index definitions are not stored ({name})")
+
+    def delete_index(self, index):
+        name = index if isinstance(index, str) else index.name
+        shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+
+    def get_search_client(self, index_name, **kwargs):
+        return LocalSearchClient(index_name, directory=self.directory)
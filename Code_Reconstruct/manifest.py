@@ -0,0 +1,71 @@
+import os
+import json
+import base64
+import hashlib
+
+# Manifests of what has been ingested into each index, one file per (index, source file)
+DEFAULT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".manifests")
+
+def image_key(image_name):
+    # Stable document key for an image, Azure keys only allow letters, digits, "_", "-" and "="
+    return base64.urlsafe_b64encode(image_name.encode("utf-8")).decode("ascii")
+
+def content_hash(document, embedding_text, model):
+    # Covers every stored field and the exact text/deployment the embedding is computed from
+    fields = {name: value for name, value in document.items() if name != "Embedding"}
+    payload = json.dumps([model, embedding_text, fields], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class Manifest:
+    # Maps document key -> content hash for the rows of one source file in one index
+    def __init__(self, index_name, source_name, directory=DEFAULT_DIR):
+        self.path = os.path.join(directory, index_name, f"{source_name}.json")
+        self.entries = {}
+        self.loaded = os.path.exists(self.path)
+        if self.loaded:
+            with open(self.path, encoding="utf-8") as f:
+                self.entries = json.load(f)
+        self.saved = dict(self.entries)
+
+    def diff(self, hashes):
+        # hashes: {key: content hash} of the current rows
+        changed = [key for key, digest in hashes.items() if self.entries.get(key) != digest]
+        deleted = [key for key in self.entries if key not in hashes]
+        return changed, deleted
+
+    def save(self):
+        # Left untouched when nothing changed, its mtime then still identifies the index contents
+        if self.entries == self.saved and os.path.exists(self.path):
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.entries, f, indent=0, sort_keys=True)
+        os.replace(tmp_path, self.path)
+        self.saved = dict(self.entries)
+
+def page_documents(search_client, order_by, select=("*",), page_docs=1000):
+    # Every document of the index. Ordered by order_by (sortable fields that identify a document,
+    # Schema.key_fields) so pages neither overlap nor skip documents. Azure caps skip at 100000,
+    # enough for the book indexes
+    skip = 0
+    while True:
+        page = list(search_client.search(search_text="*", select=list(select), order_by=list(order_by),
+                                         top=page_docs, skip=skip))
+        yield from page
+        if len(page) < page_docs:
+            return
+        skip += len(page)
+
+def index_keys(search_client, order_by, key_field="id"):
+    # Every key stored in the index, whichever run or key scheme put it there
+    return {document[key_field] for document in page_documents(search_client, order_by, select=[key_field])}
+
+def index_version(index_name, directory=DEFAULT_DIR):
+    # Changes whenever an ingestion run changed the contents of the index
+    index_dir = os.path.join(directory, index_name)
+    if not os.path.isdir(index_dir):
+        return ()
+    return tuple(sorted(
+        (entry.name, entry.stat().st_mtime_ns) for entry in os.scandir(index_dir) if entry.name.endswith(".json")
+    ))
@@ -0,0 +1,95 @@
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import setup
+from ingest import ingest
+from schemas import PAGES
+from tokenizer import encoding
+
+# PDF books straight into the Source/Page text index ("friday"), no chapter CSVs needed:
+#   python pdf_ingest.py book.pdf [another.pdf ...] [--full]
+# Pages are extracted in a process pool, split into overlapping chunks of at most
+# PDF_CHUNK_TOKENS tokens and streamed through ingest.py like the CSV loaders.
+PDF_INDEX_NAME = os.getenv("AZURE_SEARCH_INDEX_NAME_PDF", "friday")
+PDF_CHUNK_TOKENS = int(os.getenv("PDF_CHUNK_TOKENS", 500))
+PDF_CHUNK_OVERLAP = int(os.getenv("PDF_CHUNK_OVERLAP", 50))
+PDF_PAGES_PER_TASK = int(os.getenv("PDF_PAGES_PER_TASK", 8))
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", os.cpu_count() or 1))
+
+_reader = None
+
+def open_reader(path):
+    # Each worker process parses the file once and keeps the reader for all its tasks
+    global _reader
+    from pypdf import PdfReader
+    _reader = PdfReader(path)
+
+def extract_pages(first, last):
+    # [(page number from 1, text)] for pages first..last-1
+    pages = []
+    for number in range(first, last):
+        try:
+            text = _reader.pages[number].extract_text() or ""
+        except Exception as e:
+            print(f"Page {number + 1}: {e}")
+            text = ""
+        pages.append((number + 1, clean(text)))
+    return pages
+
+def clean(text):
+    text = re.sub(r"-\n(?=[a-z])", "", text)   # words hyphenated across lines
+    text = re.sub(r"[ \t]*\n[ \t]*", "\n", text)
+    text = re.sub(r"(?<!\n)\n(?!\n)", " ", text) # single line breaks inside a paragraph
+    return re.sub(r"[ \t]{2,}", " ", text).strip()
+
+def split_chunks(text, max_tokens=PDF_CHUNK_TOKENS, overlap=PDF_CHUNK_OVERLAP):
+    # Windows of max_tokens tokens, each starting overlap tokens before the end of the last
+    tokens = encoding.encode(text)
+    if len(tokens) <= max_tokens:
+        return [text] if text else []
+    step = max(1, max_tokens - overlap)
+    return [encoding.decode(tokens[start:start + max_tokens]).strip()
+            for start in range(0, len(tokens) - overlap, step)]
+
+def page_count(path):
+    from pypdf import PdfReader
+    return len(PdfReader(path).pages)
+
+def pdf_rows(path, stats, workers=PDF_WORKERS, pages_per_task=PDF_PAGES_PER_TASK):
+    # Rows for the PAGES schema, in page order while later pages are still being extracted
+    source = os.path.basename(path)
+    total = page_count(path)
+    if not total:
+        return
+    firsts = range(0, total, pages_per_task)
+    lasts = [min(first + pages_per_task, total) for first in firsts]
+    with ProcessPoolExecutor(max_workers=workers, initializer=open_reader, initargs=(path,)) as executor:
+        for pages in executor.map(extract_pages, firsts, lasts):
+            for number, text in pages:
+                stats["pages"] += 1
+                for chunk, content in enumerate(split_chunks(text)):
+                    stats["chunks"] += 1
+                    yield [source, str(number), str(chunk), content]
+
+def ingest_pdf(path, search_client, index_name, get_embeddings, model, full=False):
+    stats = {"pages": 0, "chunks": 0}
+    start = time.perf_counter()
+    report = ingest(PAGES, pdf_rows(path, stats), search_client, index_name, os.path.basename(path),
+                    get_embeddings, model, full=full)
+    seconds = time.perf_counter() - start
+    print(f"{os.path.basename(path)}: {stats['pages']} pages, {stats['chunks']} chunks in {seconds:.1f}s "
+          f"({stats['pages'] / seconds if seconds else 0:.1f} pages/s)")
+    return report
+
+def main(paths, full=False):
+    PAGES.create_or_update(setup.index_client, PDF_INDEX_NAME)
+    search_client = setup.search_client(PDF_INDEX_NAME)
+    for path in paths:
+        ingest_pdf(path, search_client, PDF_INDEX_NAME, setup.get_embeddings, setup.text_embedding_model, full=full)
+    print(f"Embedding cache: {setup.embedding_cache.stats()}")
+
+if __name__ == "__main__":
+    main([arg for arg in sys.argv[1:] if not arg.startswith("--")], full="--full" in sys.argv)
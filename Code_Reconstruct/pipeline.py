@@ -0,0 +1,266 @@
+import os
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import setup
+import tracing
+from answer_cache import SemanticCache, ANSWER_CACHE_ENABLED
+from context_packer import pack_context
+from filter_images import select_images
+from image_links import ImageLinks
+from manifest import index_version
+from section_index import SectionIndex, DEFAULT_DIR as SECTIONS_DIR
+from tokenizer import count_tokens
+
+# "concurrent" overlaps independent stages, "serial" runs them one after another like before
+pipeline_mode = os.getenv("PIPELINE_MODE", "concurrent").lower()
+
+# Context around each hit: paragraphs on either side, or the whole section
+context_neighbors = int(os.getenv("CONTEXT_NEIGHBORS", 1))
+context_whole_section = os.getenv("CONTEXT_WHOLE_SECTION", "false").lower() == "true"
+
+executor = ThreadPoolExecutor(max_workers=int(os.getenv("PIPELINE_WORKERS", 8)))
+
+# With several text indexes (AZURE_SEARCH_INDEX_NAMES_TEXT) the query goes to all of them at
+# once and the hits are merged by score. An index that fails or has not answered within
+# SEARCH_SHARD_TIMEOUT seconds is left out of the answer instead of holding it up
+search_shard_timeout = float(os.getenv("SEARCH_SHARD_TIMEOUT", 3.0))
+shard_executor = ThreadPoolExecutor(max_workers=int(os.getenv("SEARCH_FANOUT_WORKERS", 16)))
+
+# Candidate images straight from the retrieved paragraphs, see image_links.py. The keyword
+# embedding and image search after the answer only run when no linked image is found
+image_links_enabled = os.getenv("IMAGE_LINKS_ENABLED", "true").lower() == "true"
+
+# Answers to repeated and near-duplicate questions, shared by all sessions of this process and
+# dropped whenever an ingestion run changes the text or image index
+answer_cache = SemanticCache(
+    version=lambda: (tuple(index_version(name) for name in setup.text_search_index_names),
+                     index_version(setup.image_search_index_name))
+)
+
+# Paragraph order of every section, loaded again whenever an ingestion run rewrote its files
+@lru_cache(maxsize=1)
+def section_index_at(version):
+    return SectionIndex(setup.text_search_index_names)
+
+def load_section_index():
+    return section_index_at(tuple(index_version(name, SECTIONS_DIR) for name in setup.text_search_index_names))
+
+@lru_cache(maxsize=None)
+def load_image_links():
+    return ImageLinks(setup.text_search_index_names)
+
+def vector_query(vector):
+    # Imported here so that importing the pipeline does not load the search SDK models
+    from azure.search.documents.models import VectorizedQuery
+    return VectorizedQuery(vector=vector, fields="Embedding")
+
+def search_text_index(search_client, vector, top, index_name=None):
+    results = search_client.search(
+        search_text=None,
+        top=top,
+        vector_queries=[vector_query(vector)],
+    )
+    return [(result["id"], result["Content"], result["@search.score"], index_name)
+            for result in results if result["id"] != "Chapter-Section-Paragraph"]
+
+def search_text(vector, top=5, timeout=None):
+    # Global top hits over every text index, [(id, content, score, index name)] best first
+    clients = setup.text_search_clients
+    if len(clients) == 1:
+        name, client = next(iter(clients.items()))
+        hits = search_text_index(client, vector, top, name)
+        tracing.add(requests=1)
+        return hits
+
+    timeout = search_shard_timeout if timeout is None else timeout
+    futures = {shard_executor.submit(search_text_index, client, vector, top, name): name
+               for name, client in clients.items()}
+    done, late = wait(futures, timeout=timeout)
+    hits, errors = [], []
+    for future in done:
+        try:
+            hits += future.result()
+        except Exception as e:
+            print(f"Text search on {futures[future]} failed: {e}")
+            errors.append(e)
+    for future in late:
+        future.cancel()
+        print(f"Text search on {futures[future]} timed out after {timeout}s")
+    tracing.add(requests=len(futures), shard_errors=len(errors), shard_timeouts=len(late))
+    if errors and len(errors) == len(futures):
+        raise errors[0]
+    merged = {}
+    for hit in sorted(hits, key=lambda hit: -hit[2]):
+        merged.setdefault(hit[0], hit)
+    return list(merged.values())[:top]
+
+def expand_context(hits):
+    # Neighbours missing from the section index are fetched from the index their hit came from
+    clients = setup.text_search_clients
+    return load_section_index().expand(
+        [(doc_id, content) for doc_id, content, _, _ in hits], k=context_neighbors, whole_section=context_whole_section,
+        search_client=setup.text_search_client,
+        search_clients={doc_id: clients[name] for doc_id, _, _, name in hits if name in clients},
+    )
+
+def search_images(vector, top=5):
+    results = setup.image_search_client.search(
+        search_text=None,
+        top=top,
+        vector_queries=[vector_query(vector)],
+    )
+    images = [(result["Image_name"], result["Caption"], result["@search.score"]) for result in results]
+    tracing.add(requests=1)
+    return images
+
+def reconcile_images(keyword_images, speculative_images, top=5):
+    # Images found by both searches first, then the rest of the keyword results, then the
+    # speculative ones, each group in score order
+    speculative_names = {name for name, _, _ in speculative_images}
+    keyword_names = {name for name, _, _ in keyword_images}
+    both = [image for image in keyword_images if image[0] in speculative_names]
+    keyword_only = [image for image in keyword_images if image[0] not in speculative_names]
+    speculative_only = [image for image in speculative_images if image[0] not in keyword_names]
+    return (both + keyword_only + speculative_only)[:top]
+
+def keywords_from_answer(chat_content):
+    return chat_content.split("\n")[-1].replace("Keywords: ", "")
+
+def generate_answer(messages):
+    response = setup.azure_openai_client.chat.completions.create(
+        model="summer",
+        messages=messages,
+        temperature=0.7,
+    )
+    tracing.add(requests=1, prompt_tokens=response.usage.prompt_tokens, completion_tokens=response.usage.completion_tokens)
+    return response.choices[0].message.content
+
+def stream_answer(messages):
+    # Yields the answer text piece by piece as the model produces it
+    stream = setup.azure_openai_client.chat.completions.create(
+        model="summer",
+        messages=messages,
+        temperature=0.7,
+        stream=True,
+    )
+    tracing.add(requests=1)
+    for chunk in stream:
+        # Azure sends chunks without choices for content filter results
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+def stream_query(query, history, mode=None, stream=True):
+    # Runs the pipeline and yields (event, payload) as results become available:
+    # ("sources", [...]), ("prompt_tokens", int), ("token", str) one or more times, ("answer", str),
+    # ("images", [...]), ("trace", {...}) with the spans of the request, ("timings", {...}).
+    # history is a ConversationMemory, the turn is added to it once the answer is complete.
+    mode = mode or pipeline_mode
+    trace = tracing.Trace("query")
+    with trace.span("query_embedding"):
+        vector_query = setup.get_embedding(query)
+
+    # Only the first question of a conversation is answered from or stored in the cache, a
+    # follow-up such as "Who was he?" depends on the turns before it
+    use_answer_cache = ANSWER_CACHE_ENABLED and not history.turns
+    if use_answer_cache:
+        with trace.span("answer_cache_lookup"):
+            cached = answer_cache.lookup(vector_query)
+        if cached is not None:
+            chat_content, search_text_results, filtered_images = cached
+            yield "sources", search_text_results
+            yield "prompt_tokens", 0
+            trace.mark("time_to_first_token")
+            yield "token", chat_content
+            history.add_turn(query, f"{query} Source: " + " ".join(search_text_results), chat_content, cached=True)
+            yield "answer", chat_content
+            yield "images", filtered_images
+            timings = trace.finish()
+            yield "trace", trace.to_dict()
+            yield "timings", timings
+            return
+
+    def retrieve_text():
+        with trace.span("text_search"):
+            hits = search_text(vector_query)
+        print([doc_id for doc_id, _, _, _ in hits])
+        with trace.span("context_expansion"):
+            context = expand_context(hits)
+        with trace.span("context_packing"):
+            # Paragraph vectors from the embedding cache, never from the API
+            spans, stats = pack_context(
+                vector_query, hits, context, section_index=load_section_index(),
+                embedding_lookup=lambda texts: setup.embedding_cache.get_many(setup.text_embedding_model, texts),
+            )
+            tracing.add(context_tokens_raw=stats["raw_tokens"], context_tokens_packed=stats["packed_tokens"])
+        print(f"Context: {stats['packed_paragraphs']}/{stats['paragraphs']} paragraphs in {stats['spans']} spans, "
+              f"{stats['packed_tokens']} tokens packed of {stats['raw_tokens']}")
+        return spans
+
+    def retrieve_speculative_images():
+        with trace.span("speculative_image_search"):
+            return search_images(vector_query)
+
+    # In concurrent mode images relevant to the question itself are searched while the
+    # text is retrieved and the answer is generated
+    speculative = executor.submit(retrieve_speculative_images) if mode == "concurrent" else None
+    spans = retrieve_text()
+    search_text_results = ["Source: " + span.doc_id + "; Content: " + span.content for span in spans]
+    yield "sources", search_text_results
+
+    # Prompt from the conversation memory, trimmed to its token budget
+    chat_message = f"{query} Source: " + " ".join(search_text_results)
+    messages = history.messages(chat_message)
+    yield "prompt_tokens", history.prompt_tokens[-1]
+    with trace.span("chat_completion"):
+        if stream:
+            pieces = []
+            for piece in stream_answer(messages):
+                if not pieces:
+                    trace.mark("time_to_first_token") # perceived latency
+                pieces.append(piece)
+                yield "token", piece
+            chat_content = "".join(pieces)
+            # Streamed responses carry no usage, count locally
+            tracing.add(prompt_tokens=history.prompt_tokens[-1], completion_tokens=count_tokens(chat_content))
+        else:
+            chat_content = generate_answer(messages)
+            trace.mark("time_to_first_token")
+            yield "token", chat_content
+    history.add_turn(query, chat_message, chat_content)
+    yield "answer", chat_content
+
+    image_search_results = []
+    if image_links_enabled:
+        with trace.span("linked_images"):
+            image_search_results = load_image_links().images(
+                [doc_id for span in spans for _, doc_id, _ in span.paragraphs])
+    if not image_search_results:
+        # Perform image search using vector-based KEYWORDS
+        image_search_keywords = keywords_from_answer(chat_content)
+        print(image_search_keywords)
+        with trace.span("keyword_embedding"):
+            keyword_vector = setup.get_embedding(image_search_keywords)
+        with trace.span("keyword_image_search"):
+            image_search_results = search_images(keyword_vector)
+    if speculative is not None:
+        with trace.span("reconcile_images"):
+            image_search_results = reconcile_images(image_search_results, speculative.result())
+
+    with trace.span("filter_images"):
+        image_list = [(name, caption) for name, caption, _ in image_search_results]
+        filtered_image_names = select_images(setup.azure_openai_client, chat_content, image_list)
+        filtered_images = [image for image in image_list if image[0] in filtered_image_names]
+    if use_answer_cache:
+        answer_cache.store(vector_query, (chat_content, search_text_results, filtered_images))
+    yield "images", filtered_images
+    timings = trace.finish()
+    yield "trace", trace.to_dict()
+    yield "timings", timings
+
+def query_and_respond(query, history, mode=None, stream=False):
+    # Returns (answer, sources, images, timings), the turn is added to history
+    results = {}
+    for event, payload in stream_query(query, history, mode=mode, stream=stream):
+        results[event] = payload
+    return results["answer"], results["sources"], results["images"], results["timings"]
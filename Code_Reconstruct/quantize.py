@@ -0,0 +1,116 @@
+import os
+import sys
+import argparse
+import numpy as np
+
+# Compact storage of the 1536-dim embeddings we keep locally. "float16" halves float32 and
+# "int8" quarters it, with one float32 scale per vector (symmetric, max |x| -> 127). Scores
+# are computed block by block in float32, so only a block is ever expanded in memory.
+#   python quantize.py [--k 10] [--oversampling 4]   memory and recall@k on our own corpus
+VECTOR_DTYPES = ("float32", "float16", "int8")
+SCORE_BLOCK = 4096 # rows expanded to float32 at a time
+
+def quantize(matrix, dtype):
+    # (codes, scales), scales is None except for int8
+    matrix = np.asarray(matrix, dtype=np.float32)
+    if dtype == "float32":
+        return matrix, None
+    if dtype == "float16":
+        return matrix.astype(np.float16), None
+    if dtype == "int8":
+        scales = np.abs(matrix).max(axis=-1) / 127.0
+        scales = np.where(scales == 0, 1.0, scales).astype(np.float32)
+        codes = np.clip(np.rint(matrix / scales[..., None]), -127, 127).astype(np.int8)
+        return codes, scales
+    raise ValueError(f"Unknown vector dtype {dtype}, expected one of {VECTOR_DTYPES}")
+
+def dequantize(codes, scales=None):
+    matrix = np.asarray(codes, dtype=np.float32)
+    return matrix if scales is None else matrix * np.asarray(scales, dtype=np.float32)[..., None]
+
+def scores(queries, codes, scales=None, rows=None, block=SCORE_BLOCK):
+    # queries @ vectors.T for a float32 (queries, dim) matrix, optionally only for the given rows
+    rows = np.arange(len(codes)) if rows is None else np.asarray(rows, dtype=np.int64)
+    queries = np.asarray(queries, dtype=np.float32)
+    result = np.empty((len(queries), len(rows)), dtype=np.float32)
+    for start in range(0, len(rows), block):
+        part = rows[start:start + block]
+        result[:, start:start + len(part)] = queries @ dequantize(codes[part], None if scales is None else scales[part]).T
+    return result
+
+def nbytes(codes, scales=None):
+    return codes.nbytes + (0 if scales is None else scales.nbytes)
+
+def list_bytes(vector):
+    # What a vector costs as the list of Python floats the SDKs hand around
+    return sys.getsizeof(vector) + sum(sys.getsizeof(value) for value in vector)
+
+def recall_at_k(exact, approximate):
+    # Share of the exact top-k ids found in the approximate top-k, averaged over queries
+    return float(np.mean([len(set(e) & set(a)) / len(e) for e, a in zip(exact, approximate) if len(e)]))
+
+def top_ids(score_matrix, k):
+    top = np.argpartition(-score_matrix, k - 1, axis=1)[:, :k]
+    return np.take_along_axis(top, np.argsort(-np.take_along_axis(score_matrix, top, axis=1), axis=1), axis=1)
+
+def evaluate(vectors, queries, k=10, oversampling=4):
+    # Memory and recall@k of every dtype against exact float32 search. "rescored" takes the top
+    # k * oversampling by quantized score and reorders them by the float32 score, like the
+    # rerank_with_original_vectors option of the Azure index
+    vectors = np.asarray(vectors, dtype=np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    queries = np.asarray(queries, dtype=np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    k = min(k, len(vectors))
+    exact = top_ids(queries @ vectors.T, k)
+    report = {"documents": len(vectors), "queries": len(queries), "k": k,
+              "python_lists_mb": sum(list_bytes(v.tolist()) for v in vectors) / 1e6, "dtypes": {}}
+    for dtype in VECTOR_DTYPES:
+        codes, scales = quantize(vectors, dtype)
+        approximate = scores(queries, codes, scales)
+        candidates = top_ids(approximate, min(k * oversampling, len(vectors)))
+        rescored = [c[np.argsort(-(vectors[c] @ q))][:k] for c, q in zip(candidates, queries)]
+        report["dtypes"][dtype] = {
+            "mb": nbytes(codes, scales) / 1e6,
+            "recall": recall_at_k(exact, top_ids(approximate, k)),
+            "recall_rescored": recall_at_k(exact, rescored),
+        }
+    return report
+
+def print_report(name, report):
+    print(f"{name}: {report['documents']} vectors, {report['queries']} queries, recall@{report['k']}")
+    print(f"  {'storage':<14}{'MB':>10}{'recall':>10}{'rescored':>10}")
+    print(f"  {'python lists':<14}{report['python_lists_mb']:>10.2f}{1.0:>10.3f}{'':>10}")
+    for dtype, r in report["dtypes"].items():
+        print(f"  {dtype:<14}{r['mb']:>10.2f}{r['recall']:>10.3f}{r['recall_rescored']:>10.3f}")
+
+def corpus_vectors(get_embeddings, text_index_name, image_csv_path):
+    # Paragraph and image vectors the update scripts embedded, i.e. from the embedding cache
+    from ingest import read_csv
+    from schemas import IMAGE
+    from section_index import SectionIndex
+    paragraphs = [content for section in SectionIndex(text_index_name).sections.values() for _, content in section]
+    images = [IMAGE.document(row) for row in read_csv(image_csv_path)]
+    return (np.asarray(get_embeddings(paragraphs), dtype=np.float32) if paragraphs else np.zeros((0, 0)),
+            np.asarray(get_embeddings([IMAGE.embedding_text(d) for d in images]), dtype=np.float32))
+
+def main():
+    parser = argparse.ArgumentParser(description="Memory and recall@k of quantized embeddings")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--oversampling", type=int, default=4)
+    args = parser.parse_args()
+
+    import setup
+    from schemas import index_size_estimate
+    image_csv_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "outputupdated.csv")
+    paragraphs, images = corpus_vectors(setup.get_embeddings, setup.text_search_index_name, image_csv_path)
+    # Every paragraph is a query against all paragraphs (itself included), and against the images
+    if len(paragraphs):
+        print_report("paragraphs", evaluate(paragraphs, paragraphs, args.k, args.oversampling))
+        print_report("paragraphs -> images", evaluate(images, paragraphs, args.k, args.oversampling))
+    for name, count in (("text index", len(paragraphs)), ("image index", len(images))):
+        print(f"{name} vectors: " + ", ".join(f"{config} {mb:.2f} MB"
+                                             for config, mb in index_size_estimate(count).items()))
+
+if __name__ == "__main__":
+    main()
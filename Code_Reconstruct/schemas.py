@@ -0,0 +1,162 @@
+import os
+import sys
+import shutil
+
+from manifest import image_key, DEFAULT_DIR as MANIFEST_DIR
+
+# The index schemas in one place. Each schema lists its string fields, the CSV column each
+# one comes from, how the document key and the embedded text are derived, and builds the
+# SearchIndex definition for Azure. The vector field and its HNSW profile are shared.
+VECTOR_FIELD = "Embedding"
+VECTOR_DIMENSIONS = 1536 # text-embedding-ada-002
+VECTOR_PROFILE = "my-vector-config"
+VECTOR_ALGORITHM = "my-hnsw"
+
+# Vectors are stored as Edm.Half and searched through an int8 scalar-quantized HNSW graph,
+# the top VECTOR_OVERSAMPLING * k are rescored with the full vectors. The retrievable copy
+# is not stored, nothing reads vectors back from the index. Needs azure-search-documents
+# 11.5 (API 2024-07-01), with an older SDK the plain Edm.Single definition is created.
+# This applies to new indexes only: Azure cannot change an existing vector field, so
+# create_or_update keeps the live one, and an existing index moves over with
+#   python schemas.py migrate text ch4to6   (then run its update script)
+VECTOR_STORAGE = os.getenv("VECTOR_STORAGE", "half").lower()          # half | single
+VECTOR_COMPRESSION = os.getenv("VECTOR_COMPRESSION", "scalar").lower() # scalar | none
+VECTOR_OVERSAMPLING = float(os.getenv("VECTOR_OVERSAMPLING", 4))
+VECTOR_COMPRESSION_NAME = "my-scalar-quantization"
+
+def index_size_estimate(documents, dimensions=VECTOR_DIMENSIONS):
+    # MB of vector data per index configuration. With int8 compression only the quantized
+    # vectors (1 byte per dimension) are in the HNSW graph, the half vectors stay on disk for rescoring
+    mb = documents * dimensions / 1e6
+    return {"single + stored copy": 8 * mb, "single": 4 * mb, "half": 2 * mb, "half + int8": 3 * mb}
+
+def vector_search_config(compression):
+    from azure.search.documents.indexes.models import VectorSearch, VectorSearchProfile, HnswAlgorithmConfiguration
+    algorithms = [HnswAlgorithmConfiguration(name=VECTOR_ALGORITHM)]
+    if not compression:
+        return VectorSearch(
+            profiles=[VectorSearchProfile(name=VECTOR_PROFILE, algorithm_configuration_name=VECTOR_ALGORITHM)],
+            algorithms=algorithms,
+        )
+    from azure.search.documents.indexes.models import ScalarQuantizationCompression, ScalarQuantizationParameters
+    return VectorSearch(
+        profiles=[VectorSearchProfile(name=VECTOR_PROFILE, algorithm_configuration_name=VECTOR_ALGORITHM,
+                                      compression_name=VECTOR_COMPRESSION_NAME)],
+        algorithms=algorithms,
+        compressions=[ScalarQuantizationCompression(
+            compression_name=VECTOR_COMPRESSION_NAME,
+            rerank_with_original_vectors=True,
+            default_oversampling=VECTOR_OVERSAMPLING,
+            parameters=ScalarQuantizationParameters(quantized_data_type="int8"),
+        )],
+    )
+
+def warn_if_not_compact(index_name):
+    if not compact_vectors_supported() and (VECTOR_STORAGE != "single" or VECTOR_COMPRESSION != "none"):
+        print(f"azure-search-documents too old for {VECTOR_STORAGE} vectors with {VECTOR_COMPRESSION} "
+              f"compression, creating {index_name} with Edm.Single vectors")
+
+def compact_vectors_supported():
+    try:
+        from azure.search.documents.indexes.models import ScalarQuantizationCompression
+    except ImportError:
+        return False
+    return True
+
+class Schema:
+    def __init__(self, name, fields, key, embedding_text, key_fields, columns=None, sections=False):
+        self.name = name
+        self.fields = fields                  # string fields, in index order
+        self.key = key                        # document -> key
+        self.key_fields = key_fields          # sortable fields the key is made of, a stable document order
+        self.embedding_text = embedding_text  # document -> text to embed
+        self.columns = columns or {field: i for i, field in enumerate(fields)} # field -> CSV column
+        self.sections = sections              # rows are book paragraphs, see section_index.py
+
+    def document(self, row):
+        # CSV row -> document without its vector
+        document = {field: row[column] for field, column in self.columns.items()}
+        return {"id": self.key(document), **document}
+
+    def search_index(self, index_name):
+        from azure.search.documents.indexes.models import SearchIndex, SimpleField, SearchableField, SearchField
+        compact = compact_vectors_supported()
+        storage = VECTOR_STORAGE if compact else "single"
+        # Only the 2024-07-01 field model knows "stored", older SDKs keep the vectors retrievable
+        stored = {"stored": False} if compact else {}
+        return SearchIndex(
+            name=index_name,
+            # Filterable so that context expansion can fetch several paragraphs by key in one request
+            fields=[SimpleField(name="id", type="Edm.String", key=True, filterable=True)] + [
+                SearchableField(name=field, type="Edm.String", analyzer_name="standard.lucene",
+                                filterable=True, sortable=True, facetable=True, searchable=True)
+                for field in self.fields
+            ] + [
+                SearchField(name=VECTOR_FIELD, type=f"Collection(Edm.{storage.capitalize()})",
+                    hidden=compact, searchable=True, filterable=False, sortable=False, facetable=False,
+                    vector_search_dimensions=VECTOR_DIMENSIONS, vector_search_profile_name=VECTOR_PROFILE, **stored),
+            ],
+            vector_search=vector_search_config(compact and VECTOR_COMPRESSION == "scalar"),
+        )
+
+    def create_or_update(self, index_client, index_name):
+        # New indexes get search_index() as it is. An existing one keeps its fields as they are (Azure
+        # refuses to change their attributes, e.g. the vector type or a now filterable id) and its
+        # vector search settings, only fields it does not have yet are added
+        from azure.core.exceptions import ResourceNotFoundError
+        index = self.search_index(index_name)
+        try:
+            live = index_client.get_index(index_name)
+        except ResourceNotFoundError:
+            warn_if_not_compact(index_name)
+            return index_client.create_or_update_index(index)
+        live_names = {field.name for field in live.fields}
+        index.fields = list(live.fields) + [field for field in index.fields if field.name not in live_names]
+        index.vector_search = live.vector_search
+        return index_client.create_or_update_index(index)
+
+    def migrate(self, index_client, index_name):
+        # Recreates the index with the current vector settings. It is empty until the next update
+        # run, which uploads every document because the manifests of the index are cleared
+        index_client.delete_index(index_name)
+        warn_if_not_compact(index_name)
+        index_client.create_or_update_index(self.search_index(index_name))
+        shutil.rmtree(os.path.join(MANIFEST_DIR, index_name), ignore_errors=True)
+        print(f"Recreated {index_name}, run its update script to upload the documents again")
+
+# Book paragraphs, data/ch4to6.csv and OHNO/ch1to3.csv: Chapter,Section,Paragraph,Content
+TEXT = Schema(
+    "text",
+    fields=["Chapter", "Section", "Paragraph", "Content"],
+    key=lambda document: f"{document['Chapter']}-{document['Section']}-{document['Paragraph']}",
+    embedding_text=lambda document: document["Content"],
+    key_fields=["Chapter", "Section", "Paragraph"],
+    sections=True,
+)
+
+# Captioned images, outputupdated.csv: Image Name,Image Path,Response1,Response2,Caption
+IMAGE = Schema(
+    "image",
+    fields=["Image_name", "Image_path", "Response1", "Response2", "Caption"],
+    key=lambda document: image_key(document["Image_name"]), # Stable across reordering of the CSV
+    embedding_text=lambda document: f"{document['Image_name']}. {document['Caption']}",
+    key_fields=["Image_name"],
+)
+
+# PDF page chunks (the "friday" index): Source,Page,Chunk,Content, see pdf_ingest.py
+PAGES = Schema(
+    "pages",
+    fields=["Source", "Page", "Chunk", "Content"],
+    key=lambda document: image_key(f"{document['Source']}-{document['Page']}-{document['Chunk']}"),
+    embedding_text=lambda document: document["Content"],
+    key_fields=["Source", "Page", "Chunk"],
+)
+
+SCHEMAS = {schema.name: schema for schema in (TEXT, IMAGE, PAGES)}
+
+if __name__ == "__main__":
+    # python schemas.py migrate <schema> <index_name>
+    if len(sys.argv) != 4 or sys.argv[1] != "migrate" or sys.argv[2] not in SCHEMAS:
+        sys.exit(f"usage: python schemas.py migrate {{{','.join(SCHEMAS)}}} <index_name>")
+    import setup
+    SCHEMAS[sys.argv[2]].migrate(setup.index_client, sys.argv[3])
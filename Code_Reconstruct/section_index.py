@@ -0,0 +1,147 @@
+import os
+import json
+import glob
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+import tracing
+
+# (chapter, section) -> ordered paragraphs, written at ingestion time,
+# one file per (index, source file) so several books can share an index
+DEFAULT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".sections")
+
+def split_key(doc_id):
+    # "4-12-10" -> ("4", "12", "10"), works for any number of digits
+    chapter, section, paragraph = doc_id.rsplit("-", 2)
+    return chapter, section, paragraph
+
+def section_key(chapter, section):
+    return f"{chapter}-{section}"
+
+def build_sections(sections):
+    # sections: rows with Chapter/Section/Paragraph/Content as produced by the CSV loaders
+    index = {}
+    for row in sections:
+        if not row["Paragraph"].isdigit(): # CSV header row
+            continue
+        key = section_key(row["Chapter"], row["Section"])
+        index.setdefault(key, []).append((int(row["Paragraph"]), row["id"], row["Content"]))
+    return {key: [[doc_id, content] for _, doc_id, content in sorted(paragraphs)]
+            for key, paragraphs in index.items()}
+
+def save_section_index(index_name, source_name, sections, directory=DEFAULT_DIR):
+    path = os.path.join(directory, index_name, f"{source_name}.json")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(build_sections(sections), f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+# Clients of indexes created before id was filterable, they get one get_document per key
+unfilterable_clients = weakref.WeakSet()
+FETCH_WORKERS = 8
+
+def get_documents(search_client, ids, fields):
+    # Concurrent get_document calls, keys that do not exist are left out
+    from azure.core.exceptions import ResourceNotFoundError
+    def get(doc_id):
+        try:
+            return search_client.get_document(key=doc_id, selected_fields=list(fields))
+        except ResourceNotFoundError:
+            return None
+    with ThreadPoolExecutor(max_workers=min(FETCH_WORKERS, len(ids))) as pool:
+        results = [result for result in pool.map(get, ids) if result is not None]
+    tracing.add(requests=len(ids))
+    return {result["id"]: result["Content"] for result in results}
+
+def fetch_documents(search_client, ids, fields=("id", "Content")):
+    # One filtered request instead of a get_document round trip per key
+    from azure.core.exceptions import HttpResponseError
+    if not ids:
+        return {}
+    if search_client in unfilterable_clients:
+        return get_documents(search_client, ids, fields)
+    try:
+        results = list(search_client.search(
+            search_text="*",
+            filter=f"search.in(id, '{','.join(ids)}', ',')",
+            select=list(fields),
+            top=len(ids),
+        ))
+    except HttpResponseError as e:
+        # id is not filterable in indexes created before it was
+        print(f"Filter on id rejected ({e.status_code}), fetching the {len(ids)} paragraphs one by one")
+        unfilterable_clients.add(search_client)
+        return get_documents(search_client, ids, fields)
+    documents = {result["id"]: result["Content"] for result in results}
+    tracing.add(requests=1)
+    return documents
+
+class SectionIndex:
+    def __init__(self, index_names, directory=DEFAULT_DIR):
+        # One index name or several, whose paragraph ids do not overlap
+        index_names = [index_names] if isinstance(index_names, str) else index_names
+        self.sections = {}
+        paths = [path for name in index_names for path in sorted(glob.glob(os.path.join(directory, name, "*.json")))]
+        for path in paths:
+            with open(path, encoding="utf-8") as f:
+                self.sections.update(json.load(f))
+        self.positions = {}
+        for key, paragraphs in self.sections.items():
+            for position, (doc_id, _) in enumerate(paragraphs):
+                self.positions[doc_id] = (key, position)
+
+    def __contains__(self, doc_id):
+        return doc_id in self.positions
+
+    def neighbors(self, doc_id, k=1):
+        # Ids of the paragraphs within k of doc_id in its section, doc_id included, in reading order
+        if doc_id in self.positions:
+            key, position = self.positions[doc_id]
+            paragraphs = self.sections[key]
+            return [paragraph_id for paragraph_id, _ in paragraphs[max(0, position - k):position + k + 1]]
+        # Not ingested with a section index, guess the neighbors from the key
+        try:
+            chapter, section, paragraph = split_key(doc_id)
+            paragraph = int(paragraph)
+        except ValueError:
+            return [doc_id]
+        return [f"{chapter}-{section}-{p}" for p in range(max(0, paragraph - k), paragraph + k + 1)]
+
+    def section(self, doc_id):
+        if doc_id not in self.positions:
+            return [doc_id]
+        key, _ = self.positions[doc_id]
+        return [paragraph_id for paragraph_id, _ in self.sections[key]]
+
+    def content(self, doc_id):
+        if doc_id not in self.positions:
+            return None
+        key, position = self.positions[doc_id]
+        return self.sections[key][position][1]
+
+    def expand(self, hits, k=1, whole_section=False, search_client=None, search_clients=None):
+        # hits: [(id, content)] from the vector search. Returns unique [(id, content)], the context
+        # window of each hit in reading order, hits taken in rank order. Content comes from memory,
+        # anything the index does not know is fetched with one batched lookup per client: the
+        # hit's own from search_clients (hit id -> client), else search_client.
+        known = dict(hits)
+        ordered = []
+        owner = {} # context id -> the hit it was taken for
+        for doc_id, _ in hits:
+            context = self.section(doc_id) if whole_section else self.neighbors(doc_id, k)
+            for context_id in context:
+                if context_id not in ordered:
+                    ordered.append(context_id)
+                    owner[context_id] = doc_id
+        for doc_id in ordered:
+            if doc_id not in known and doc_id in self.positions:
+                known[doc_id] = self.content(doc_id)
+        missing = {}
+        for doc_id in ordered:
+            client = (search_clients or {}).get(owner[doc_id], search_client)
+            if doc_id not in known and client is not None:
+                missing.setdefault(id(client), (client, []))[1].append(doc_id)
+        for client, ids in missing.values():
+            known.update(fetch_documents(client, ids))
+        return [(doc_id, known[doc_id]) for doc_id in ordered if doc_id in known]
@@ -1,40 +1,140 @@
 import os
-import base64
-import re
-import csv
-from dotenv import load_dotenv, find_dotenv
-from azure.core.credentials import AzureKeyCredential
-from azure.search.documents import SearchClient
-from azure.search.documents.indexes import SearchIndexClient
-from azure.search.documents.indexes.models import *
-from azure.search.documents.models import VectorizedQuery
-from openai import AzureOpenAI
+import time
+import threading
+from functools import wraps
+from dotenv import load_dotenv
+
+import tracing
+from embedding_cache import EmbeddingCache, DEFAULT_PATH, DEFAULT_MAX_ENTRIES
 
 
 # Get Environment settings from .env file
 load_dotenv()
 
+# Search backend: "azure" (default) or "local" for the in-process NumPy index in local_search.py
+search_backend = os.getenv("SEARCH_BACKEND", "azure").lower()
+
 # Azure AI Search Index Settings
-service_endpoint = f"{os.getenv('AZURE_SEARCH_SERVICE_ENDPOINT')}"
-index_creds = AzureKeyCredential(os.getenv("AZURE_SEARCH_INDEX_KEY"))
 text_search_index_name = os.getenv("AZURE_SEARCH_INDEX_NAME_TEXT")
 image_search_index_name = os.getenv("AZURE_SEARCH_INDEX_NAME_IMAGE")
 
-## Create a client for handling creation of indexes
-index_client = SearchIndexClient(service_endpoint, index_creds)
-## Create a client for querying the index``
-text_search_client = SearchClient(endpoint=service_endpoint, index_name=text_search_index_name, credential=index_creds)
-image_search_client = SearchClient(endpoint=service_endpoint, index_name=image_search_index_name, credential=index_creds)
-
-# Azure Openai Settings
-azure_openai_client = AzureOpenAI(
-    api_key = os.getenv("OPENAI_API_KEY"),
-    api_version = os.getenv("OPENAI_API_VERSION"),
-    azure_endpoint = os.getenv("OPENAI_API_ENDPOINT")
-)
+# Text indexes searched together, e.g. "ch1to3,ch4to6" for a corpus split by chapter range,
+# by default only the text index above
+text_search_index_names = [
+    name.strip() for name in os.getenv("AZURE_SEARCH_INDEX_NAMES_TEXT", "").split(",") if name.strip()
+] or [text_search_index_name]
 
 # Text Embedding (model=[Deployment Name], DONOT change this)
 text_embedding_model = os.getenv("TEXT_EMBEDDING_MODEL_NAME")
+
+# The clients below are built on first use, once per process, and then shared by every
+# Streamlit rerun and session (the module stays in sys.modules), so their HTTP connection
+# pools are reused. Heavy SDK imports happen inside the builders for the same reason.
+# setup.text_search_client etc. still work as plain attributes through __getattr__.
+startup_timings = {}   # resource -> seconds spent importing and constructing it
+_lock = threading.RLock()
+
+def resource(build):
+    instance = []
+    @wraps(build)
+    def get():
+        if not instance:
+            with _lock:
+                if not instance:
+                    start = time.perf_counter()
+                    instance.append(build())
+                    startup_timings[build.__name__[len("get_"):]] = time.perf_counter() - start
+        return instance[0]
+    def override(value):
+        instance[:] = [value]
+    get.override = override
+    return get
+
+@resource
+def get_index_client():
+    if search_backend == "local":
+        ## Same client surface, backed by memory-mapped files under LOCAL_SEARCH_DIR
+        from local_search import LocalSearchIndexClient, DEFAULT_DIR as LOCAL_SEARCH_DIR
+        return LocalSearchIndexClient(os.getenv("LOCAL_SEARCH_DIR", LOCAL_SEARCH_DIR))
+    from azure.search.documents.indexes import SearchIndexClient
+    ## Create a client for handling creation of indexes
+    return SearchIndexClient(search_service_endpoint(), search_credential())
+
+def search_service_endpoint():
+    return f"{os.getenv('AZURE_SEARCH_SERVICE_ENDPOINT')}"
+
+def search_credential():
+    from azure.core.credentials import AzureKeyCredential
+    return AzureKeyCredential(os.getenv("AZURE_SEARCH_INDEX_KEY"))
+
+def search_client(index_name):
+    if search_backend == "local":
+        return get_index_client().get_search_client(index_name)
+    from azure.search.documents import SearchClient
+    ## Create a client for querying the index
+    return SearchClient(endpoint=search_service_endpoint(), index_name=index_name, credential=search_credential())
+
+@resource
+def get_text_search_client():
+    return search_client(text_search_index_name)
+
+@resource
+def get_text_search_clients():
+    # index name -> client for every text index, the default one shares its client
+    return {name: get_text_search_client() if name == text_search_index_name else search_client(name)
+            for name in text_search_index_names}
+
+@resource
+def get_image_search_client():
+    return search_client(image_search_index_name)
+
+# Azure Openai Settings
+@resource
+def get_azure_openai_client():
+    from openai import AzureOpenAI
+    return AzureOpenAI(
+        api_key = os.getenv("OPENAI_API_KEY"),
+        api_version = os.getenv("OPENAI_API_VERSION"),
+        azure_endpoint = os.getenv("OPENAI_API_ENDPOINT")
+    )
+
+# On-disk embedding cache shared by indexing and querying
+@resource
+def get_embedding_cache():
+    return EmbeddingCache(
+        path = os.getenv("EMBEDDING_CACHE_PATH", DEFAULT_PATH),
+        max_entries = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", DEFAULT_MAX_ENTRIES))
+    )
+
+RESOURCES = {
+    "index_client": get_index_client,
+    "text_search_client": get_text_search_client,
+    "text_search_clients": get_text_search_clients,
+    "image_search_client": get_image_search_client,
+    "azure_openai_client": get_azure_openai_client,
+    "embedding_cache": get_embedding_cache,
+}
+
+def __getattr__(name):
+    # setup.<resource> builds the resource the first time it is read
+    if name in RESOURCES:
+        return RESOURCES[name]()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def override(**resources):
+    # Use the given objects instead of building the clients, e.g. the stand-ins in fakes.py
+    for name, value in resources.items():
+        RESOURCES[name].override(value)
+
+def setup():
+    # All clients at once, for scripts that use them straight away
+    return get_text_search_client(), get_image_search_client(), get_index_client(), get_azure_openai_client()
+
 def get_embedding(text, model=text_embedding_model): # model=[Deployment Name], DONOT change this
-   text = text.replace("\n", " ")
-   return azure_openai_client.embeddings.create(input = [text], model=model).data[0].embedding
\ No newline at end of file
+   return get_embeddings([text], model=model)[0].tolist() # the search SDK sends the query vector as JSON
+
+# Batched embedding for indexing, packs many texts into each request and keeps the input order
+def get_embeddings(texts, model=text_embedding_model):
+   import embeddings
+   with tracing.span("embeddings"):
+       return embeddings.get_embeddings(get_azure_openai_client(), texts, model, cache=get_embedding_cache())
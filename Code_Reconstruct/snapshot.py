@@ -0,0 +1,157 @@
+import os
+import sys
+import gzip
+import json
+import time
+import shutil
+import argparse
+import numpy as np
+
+import setup
+import manifest
+import section_index
+import image_links
+from bulk_upload import bulk_index
+from schemas import SCHEMAS, VECTOR_FIELD
+
+# Index snapshots: the documents of an index as columnar gzipped JSON and the vectors as one
+# .npy matrix, so an index can be restored under any name without embedding anything.
+#   python snapshot.py export ch4to6 [--schema text] [--dtype float32]
+#   python snapshot.py restore .snapshots/ch4to6 ch4to6-copy
+# The manifests, section index and image links of the index go along, so incremental updates
+# and the app keep working against the restored name.
+DEFAULT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".snapshots")
+SNAPSHOT_PAGE_DOCS = int(os.getenv("SNAPSHOT_PAGE_DOCS", 1000))       # documents per search request
+SNAPSHOT_RESTORE_DOCS = int(os.getenv("SNAPSHOT_RESTORE_DOCS", 10000)) # documents per bulk_index call
+SNAPSHOT_DTYPES = ("float32", "float16") # by default the type of the index's vector field
+
+def detect_schema(document):
+    for schema in SCHEMAS.values():
+        if all(field in document for field in schema.fields):
+            return schema
+    raise ValueError(f"No schema has the fields {sorted(document)}, pass --schema")
+
+def vector_dtype(index_client, index_name):
+    # float16 for Edm.Half vector fields, float32 otherwise (and when the definition is not available)
+    from azure.core.exceptions import ResourceNotFoundError
+    try:
+        fields = index_client.get_index(index_name).fields
+    except ResourceNotFoundError:
+        return "float32"
+    types = {field.name: field.type for field in fields}
+    return "float16" if types.get(VECTOR_FIELD) == "Collection(Edm.Half)" else "float32"
+
+def has_vector(document):
+    # The cache gives arrays, the index lists
+    return document.get(VECTOR_FIELD) is not None and len(document[VECTOR_FIELD]) > 0
+
+def missing_vectors(documents, schema, cache, model):
+    # Indexes created with stored=False do not return their vectors, take them from the embedding cache
+    positions = [i for i, document in enumerate(documents) if not has_vector(document)]
+    if positions:
+        found = cache.get_many(model, [schema.embedding_text(documents[i]) for i in positions])
+        for j, i in enumerate(positions):
+            if j in found:
+                documents[i][VECTOR_FIELD] = found[j]
+    return [documents[i]["id"] for i in positions if not has_vector(documents[i])]
+
+def state_paths(index_name, state_dir):
+    # (live path, path in the snapshot) of the manifests, section index and image links of an index
+    return [
+        (os.path.join(manifest.DEFAULT_DIR, index_name), os.path.join(state_dir, "manifests")),
+        (os.path.join(section_index.DEFAULT_DIR, index_name), os.path.join(state_dir, "sections")),
+        (image_links.links_path(index_name), os.path.join(state_dir, "image_links.json")),
+    ]
+
+def copy_path(source, target):
+    if os.path.isdir(source):
+        shutil.copytree(source, target, dirs_exist_ok=True)
+    elif os.path.exists(source):
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.copyfile(source, target)
+
+def export_index(index_name, search_client, out_dir, schema=None, dtype="float32", cache=None, model=None):
+    start = time.perf_counter()
+    count = search_client.get_document_count()
+    first = list(search_client.search(search_text="*", select=["*"], top=1))
+    if not first:
+        raise ValueError(f"Index {index_name} is empty")
+    schema = schema or detect_schema(first[0])
+    documents = list(manifest.page_documents(search_client, schema.key_fields, page_docs=SNAPSHOT_PAGE_DOCS))
+    if len(documents) != count:
+        raise ValueError(f"Read {len(documents)} of the {count} documents of {index_name}, "
+                         "was it updated during the export?")
+    missing = missing_vectors(documents, schema, cache, model) if cache is not None else []
+    if missing:
+        raise ValueError(f"No vector for {len(missing)} documents of {index_name} (e.g. {missing[:3]}), "
+                         "run the update script for it before exporting")
+
+    os.makedirs(out_dir, exist_ok=True)
+    matrix = np.asarray([document[VECTOR_FIELD] for document in documents], dtype=dtype)
+    np.save(os.path.join(out_dir, "embeddings.npy"), matrix)
+    columns = {field: [document.get(field) for document in documents] for field in ["id"] + schema.fields}
+    with gzip.open(os.path.join(out_dir, "documents.json.gz"), "wt", encoding="utf-8") as f:
+        json.dump({"index_name": index_name, "schema": schema.name, "created": time.time(),
+                   "count": len(documents), "dtype": dtype, "columns": columns}, f, ensure_ascii=False)
+    for live, saved in state_paths(index_name, os.path.join(out_dir, "state")):
+        copy_path(live, saved)
+    seconds = time.perf_counter() - start
+    size = sum(os.path.getsize(os.path.join(out_dir, name)) for name in ("embeddings.npy", "documents.json.gz"))
+    print(f"Exported {len(documents)} documents of {index_name} to {out_dir} "
+          f"({size / 1024 / 1024:.1f} MB) in {seconds:.1f}s")
+    return len(documents)
+
+def load_snapshot(snapshot_dir):
+    with gzip.open(os.path.join(snapshot_dir, "documents.json.gz"), "rt", encoding="utf-8") as f:
+        header = json.load(f)
+    return header, np.load(os.path.join(snapshot_dir, "embeddings.npy"), mmap_mode="r")
+
+def restore_index(snapshot_dir, index_name, index_client, search_client, chunk_docs=SNAPSHOT_RESTORE_DOCS):
+    # Creates (or updates) index_name with the snapshot's schema and uploads every document
+    start = time.perf_counter()
+    header, matrix = load_snapshot(snapshot_dir)
+    schema = SCHEMAS[header["schema"]]
+    schema.create_or_update(index_client, index_name)
+    columns = header["columns"]
+    succeeded, failed = 0, {}
+    for first in range(0, header["count"], chunk_docs):
+        last = min(first + chunk_docs, header["count"])
+        vectors = np.asarray(matrix[first:last], dtype=np.float32)
+        documents = [{**{field: values[i] for field, values in columns.items()}, VECTOR_FIELD: vectors[i - first].tolist()}
+                     for i in range(first, last)]
+        report = bulk_index(search_client, documents, action="upload")
+        succeeded += len(report.succeeded)
+        failed.update(report.failed)
+    for live, saved in state_paths(index_name, os.path.join(snapshot_dir, "state")):
+        copy_path(saved, live)
+    seconds = time.perf_counter() - start
+    print(f"Restored {succeeded}/{header['count']} documents of {header['index_name']} into {index_name} "
+          f"in {seconds:.1f}s ({succeeded / seconds if seconds else 0:.0f} docs/s), no embedding calls")
+    return succeeded, failed, seconds
+
+def main():
+    parser = argparse.ArgumentParser(description="Export an index to a snapshot or restore one")
+    commands = parser.add_subparsers(dest="command", required=True)
+    export_parser = commands.add_parser("export")
+    export_parser.add_argument("index_name")
+    export_parser.add_argument("--out", help=f"snapshot directory, default {DEFAULT_DIR}/<index_name>")
+    export_parser.add_argument("--schema", choices=sorted(SCHEMAS), help="detected from the fields by default")
+    export_parser.add_argument("--dtype", choices=SNAPSHOT_DTYPES, help="the type of the vector field by default")
+    restore_parser = commands.add_parser("restore")
+    restore_parser.add_argument("snapshot_dir")
+    restore_parser.add_argument("index_name")
+    args = parser.parse_args()
+
+    if args.command == "export":
+        export_index(args.index_name, setup.search_client(args.index_name),
+                     args.out or os.path.join(DEFAULT_DIR, args.index_name),
+                     schema=SCHEMAS.get(args.schema), dtype=args.dtype or vector_dtype(setup.index_client, args.index_name),
+                     cache=setup.embedding_cache, model=setup.text_embedding_model)
+    else:
+        _, failed, _ = restore_index(args.snapshot_dir, args.index_name, setup.index_client,
+                                     setup.search_client(args.index_name))
+        if failed:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+import os
+import sys
+import time
+import hashlib
+from io import BytesIO
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, features
+
+# Sidebar-sized derivatives of the archive images, stored on disk under the hash of the source
+# file so a replaced image never shows a stale thumbnail, and kept in memory once served
+DEFAULT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".thumbnails")
+IMAGE_DIR = os.getenv("IMAGE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "jpg"))
+THUMBNAIL_WIDTH = int(os.getenv("THUMBNAIL_WIDTH", 480))      # 2x the sidebar width for sharp HiDPI
+THUMBNAIL_QUALITY = int(os.getenv("THUMBNAIL_QUALITY", 80))
+THUMBNAIL_FORMAT = "WEBP" if features.check("webp") else "JPEG"
+THUMBNAIL_CACHE_ENTRIES = int(os.getenv("THUMBNAIL_CACHE_ENTRIES", 512))
+
+@lru_cache(maxsize=4096)
+def file_hash(path, mtime_ns, size):
+    # mtime and size are part of the key so the file is only read again after it changed
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def source_hash(path):
+    stat = os.stat(path)
+    return file_hash(os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+def thumbnail_path(path, width=THUMBNAIL_WIDTH, directory=DEFAULT_DIR):
+    extension = ".webp" if THUMBNAIL_FORMAT == "WEBP" else ".jpg"
+    return os.path.join(directory, f"{source_hash(path)}-{width}{extension}")
+
+def make_thumbnail(path, width=THUMBNAIL_WIDTH):
+    with Image.open(path) as img:
+        img.draft("RGB", (width, width))
+        img.thumbnail((width, width * 4), reducing_gap=2.0)
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        img_bytes = BytesIO()
+        img.save(img_bytes, format=THUMBNAIL_FORMAT, quality=THUMBNAIL_QUALITY)
+    return img_bytes.getvalue()
+
+def ensure_thumbnail(path, width=THUMBNAIL_WIDTH, directory=DEFAULT_DIR):
+    # Path of the stored thumbnail, generated on first request
+    target = thumbnail_path(path, width, directory)
+    if not os.path.exists(target):
+        os.makedirs(directory, exist_ok=True)
+        data = make_thumbnail(path, width)
+        tmp_path = f"{target}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, target)
+    return target
+
+@lru_cache(maxsize=THUMBNAIL_CACHE_ENTRIES)
+def load_thumbnail(target):
+    with open(target, "rb") as f:
+        return f.read()
+
+def get_thumbnail(name, image_dir=IMAGE_DIR, width=THUMBNAIL_WIDTH):
+    # Thumbnail bytes for an image of the archive, for st.image
+    return load_thumbnail(ensure_thumbnail(os.path.join(image_dir, name), width))
+
+def pregenerate(image_dir=IMAGE_DIR, width=THUMBNAIL_WIDTH, workers=8):
+    names = [name for name in sorted(os.listdir(image_dir))
+             if os.path.splitext(name)[1].lower() in (".jpg", ".jpeg", ".png", ".tif", ".webp")]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        targets = list(executor.map(lambda name: ensure_thumbnail(os.path.join(image_dir, name), width), names))
+    source_bytes = sum(os.path.getsize(os.path.join(image_dir, name)) for name in names)
+    thumbnail_bytes = sum(os.path.getsize(target) for target in targets)
+    print(f"{len(names)} thumbnails in {time.perf_counter() - start:.1f}s, "
+          f"{source_bytes / 1024 / 1024:.1f} MB of images -> {thumbnail_bytes / 1024 / 1024:.1f} MB of thumbnails")
+
+if __name__ == "__main__":
+    # python thumbnails.py [image_dir]
+    pregenerate(*sys.argv[1:2])
@@ -0,0 +1,29 @@
+import re
+import tiktoken
+
+# Local token counting for the embedding and chat deployments (cl100k_base). tiktoken downloads
+# the encoding on first use, without network access it falls back to an approximation of
+# about one token per four characters, good enough for budgets and batching.
+class ApproximateEncoding:
+    pattern = re.compile(r"\s?\w{1,4}|\s?[^\w\s]|\s+")
+
+    def encode(self, text):
+        return self.pattern.findall(text)
+
+    def decode(self, tokens):
+        return "".join(tokens)
+
+try:
+    encoding = tiktoken.get_encoding("cl100k_base")
+except Exception as e:
+    print(f"tiktoken encoding unavailable ({type(e).__name__}), approximating token counts")
+    encoding = ApproximateEncoding()
+
+def count_tokens(text):
+    return len(encoding.encode(text))
+
+def truncate(text, max_tokens):
+    tokens = encoding.encode(text)
+    if len(tokens) <= max_tokens:
+        return text, len(tokens)
+    return encoding.decode(tokens[:max_tokens]), max_tokens
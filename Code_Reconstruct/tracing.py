@@ -0,0 +1,206 @@
+import os
+import json
+import time
+import uuid
+import threading
+import contextvars
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Spans for the stages of a request: duration plus counters such as requests, prompt_tokens,
+# completion_tokens, retries and cache_hits that the code inside the span adds with add().
+# Finished spans feed process-wide metrics (Prometheus text format, see metrics_text()) and
+# every finished trace is appended to TRACE_LOG as one JSON line (empty to disable).
+TRACE_LOG = os.getenv("TRACE_LOG", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".traces", "traces.jsonl"))
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)  # seconds
+
+_current = contextvars.ContextVar("span", default=None)
+
+class Span:
+    def __init__(self, name, parent=None, trace=None):
+        self.name = name
+        self.parent = parent
+        self.trace = trace or (parent.trace if parent else None)
+        self.start = time.perf_counter()
+        self.seconds = None
+        self.error = None
+        self.counts = {}
+
+    def add(self, **counts):
+        for key, value in counts.items():
+            if value:
+                self.counts[key] = self.counts.get(key, 0) + value
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "parent": self.parent.name if self.parent else None,
+            "offset": self.start - self.trace.root.start if self.trace else 0.0,
+            "seconds": self.seconds,
+            "error": self.error,
+            **self.counts,
+        }
+
+def add(**counts):
+    # Counters for the innermost open span, ignored outside of any span
+    current = _current.get()
+    if current is not None:
+        current.add(**counts)
+
+@contextmanager
+def span(name, parent=None):
+    # Child of the current span, or of parent when given (for work handed to another thread)
+    current = Span(name, parent or _current.get())
+    token = _current.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.error = type(e).__name__
+        raise
+    finally:
+        current.seconds = time.perf_counter() - current.start
+        _current.reset(token)
+        metrics.observe(current)
+        if current.trace:
+            current.trace.record(current)
+
+class Trace:
+    # One request. Replaces the per-request StageTimer of the pipeline: timings() gives the
+    # duration of each top-level stage, marks and the total, like before.
+    def __init__(self, name):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.started = time.time()
+        self.root = Span(name, trace=self)
+        self.spans = []
+        self.marks = {}
+        self.lock = threading.Lock()
+
+    def span(self, name):
+        return span(name, parent=self.root)
+
+    def record(self, finished):
+        with self.lock:
+            self.spans.append(finished)
+
+    def mark(self, name):
+        # Time from the start of the request until now, e.g. time to first token
+        with self.lock:
+            self.marks[name] = time.perf_counter() - self.root.start
+
+    def timings(self):
+        with self.lock:
+            timings = {s.name: s.seconds for s in self.spans if s.parent is self.root}
+            timings.update(self.marks)
+        if self.root.seconds is not None:
+            timings["total"] = self.root.seconds
+        return timings
+
+    def totals(self):
+        totals = {}
+        for s in self.spans:
+            for key, value in s.counts.items():
+                totals[key] = totals.get(key, 0) + value
+        return totals
+
+    def to_dict(self):
+        return {
+            "trace": self.id,
+            "name": self.name,
+            "time": self.started,
+            "timings": self.timings(),
+            "totals": self.totals(),
+            "spans": [s.to_dict() for s in self.spans],
+        }
+
+    def finish(self):
+        self.root.seconds = time.perf_counter() - self.root.start
+        metrics.observe(self.root)
+        if TRACE_LOG:
+            write_json_line(TRACE_LOG, self.to_dict())
+        return self.timings()
+
+_log_lock = threading.Lock()
+
+def write_json_line(path, record):
+    with _log_lock:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+class Metrics:
+    # Per stage: duration histogram, error count and the sum of each counter
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}
+
+    def observe(self, finished):
+        with self.lock:
+            stage = self.stages.setdefault(
+                finished.name, {"buckets": [0] * len(BUCKETS), "count": 0, "sum": 0.0, "errors": 0, "counts": {}}
+            )
+            stage["count"] += 1
+            stage["sum"] += finished.seconds
+            for i, bound in enumerate(BUCKETS):
+                if finished.seconds <= bound:
+                    stage["buckets"][i] += 1
+            if finished.error:
+                stage["errors"] += 1
+            for key, value in finished.counts.items():
+                stage["counts"][key] = stage["counts"].get(key, 0) + value
+
+    def text(self):
+        lines = [
+            "# TYPE rag_stage_duration_seconds histogram",
+        ]
+        with self.lock:
+            stages = sorted(self.stages.items())
+            for name, stage in stages:
+                for bound, count in zip(BUCKETS, stage["buckets"]):
+                    lines.append(f'rag_stage_duration_seconds_bucket{{stage="{name}",le="{bound}"}} {count}')
+                lines.append(f'rag_stage_duration_seconds_bucket{{stage="{name}",le="+Inf"}} {stage["count"]}')
+                lines.append(f'rag_stage_duration_seconds_sum{{stage="{name}"}} {stage["sum"]:.6f}')
+                lines.append(f'rag_stage_duration_seconds_count{{stage="{name}"}} {stage["count"]}')
+            lines.append("# TYPE rag_stage_errors_total counter")
+            for name, stage in stages:
+                lines.append(f'rag_stage_errors_total{{stage="{name}"}} {stage["errors"]}')
+            keys = sorted({key for _, stage in stages for key in stage["counts"]})
+            for key in keys:
+                lines.append(f"# TYPE rag_{key}_total counter")
+                for name, stage in stages:
+                    if key in stage["counts"]:
+                        lines.append(f'rag_{key}_total{{stage="{name}"}} {stage["counts"][key]}')
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+def metrics_text():
+    return metrics.text()
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics_text().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+_server = None
+_server_lock = threading.Lock()
+
+def start_metrics_server(port, host="0.0.0.0"):
+    # Serves /metrics from a daemon thread, once per process however often it is called
+    global _server
+    with _server_lock:
+        if _server is None:
+            _server = ThreadingHTTPServer((host, port), MetricsHandler)
+            threading.Thread(target=_server.serve_forever, daemon=True).start()
+            print(f"Metrics on http://{host}:{port}/metrics")
+    return _server
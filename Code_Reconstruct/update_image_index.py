@@ -1,17 +1,15 @@
 import os
-import base64
-import re
-import csv
-from dotenv import load_dotenv, find_dotenv
-from azure.core.credentials import AzureKeyCredential
-from azure.search.documents import SearchClient
-from azure.search.documents.indexes import SearchIndexClient
-from azure.search.documents.indexes.models import *
-from azure.search.documents.models import VectorizedQuery
-import openai
-from openai import AzureOpenAI
+import sys
 
 import setup
+import thumbnails
+from image_dedup import find_duplicates, caption_names, unique_rows
+from ingest import ingest, read_csv
+from image_links import build_image_links
+from schemas import IMAGE
+
+# Only new or changed rows are embedded and uploaded, pass --full to rebuild everything
+full_rebuild = "--full" in sys.argv
 
 # get current directory
 path = os.getcwd()
@@ -23,24 +21,20 @@ print(parent_dir)
 
 csv_path = os.path.join(parent_dir, "outputupdated.csv")
 
-images = []
-batch_num = 1 # The batch of images uploaded
-with open(csv_path, 'rt', newline='', encoding='utf-8', errors='ignore') as csvfile:
-    csvreader = csv.reader(csvfile)
-    item_num = 1
-    for item in csvreader:
-        image_item = {
-            "id": f"{batch_num}-{item_num}",
-            "Image_name": item[0],
-            "Image_path": item[1],
-            "Caption": item[4],
-            "Embedding": setup.get_embedding(f"{item[0]}. {item[4]}")
-        }
-        item_num += 1
-        images.append(image_item)
-print(f"Finished Indexing: {len(images)} items in total")
-
-image_upload_results = setup.image_search_client.upload_documents(documents=images)
-print("Uploading")
-succeeded = sum([1 for r in image_upload_results if r.succeeded])
-print(f"Indexed {len(image_upload_results)} sections, {succeeded} succeeded")
\ No newline at end of file
+# Near-duplicate copies of an image are not indexed, the captioned copy stands for all of them
+duplicates = find_duplicates(preferred=caption_names(csv_path))
+print(f"Skipping {len(duplicates)} duplicate images")
+
+# Streamed CSV -> document -> embedding -> upload, see ingest.py
+ingest(
+    IMAGE, unique_rows(read_csv(csv_path), duplicates), setup.image_search_client, setup.image_search_index_name,
+    os.path.basename(csv_path), setup.get_embeddings, setup.text_embedding_model, full=full_rebuild, sole_source=True,
+)
+
+# Paragraph -> image candidates for the app, from the vectors just cached
+for text_index_name in setup.text_search_index_names:
+    build_image_links(text_index_name, csv_path, setup.get_embeddings, duplicates=duplicates)
+print(f"Embedding cache: {setup.embedding_cache.stats()}")
+
+# Sidebar thumbnails for new or replaced images, so the app never resizes on a request
+thumbnails.pregenerate()
@@ -1,17 +1,14 @@
 import os
-import base64
-import re
-import csv
-from dotenv import load_dotenv, find_dotenv
-from azure.core.credentials import AzureKeyCredential
-from azure.search.documents import SearchClient
-from azure.search.documents.indexes import SearchIndexClient
-from azure.search.documents.indexes.models import *
-from azure.search.documents.models import VectorizedQuery
-import openai
-from openai import AzureOpenAI
+import sys
 
 import setup
+from ingest import ingest, read_csv
+from image_dedup import find_duplicates, caption_names
+from image_links import build_image_links
+from schemas import TEXT
+
+# Only new or changed rows are embedded and uploaded, pass --full to rebuild everything
+full_rebuild = "--full" in sys.argv
 
 # get current directory
 path = os.getcwd()
@@ -22,23 +19,14 @@ data_dir = os.path.join(path, "data")
 
 csv_path = os.path.join(data_dir, "ch4to6.csv")
 
-sections = []
-with open(csv_path, 'rt', newline='', encoding='utf-8', errors='ignore') as csvfile:
-    csvreader = csv.reader(csvfile)
-    for item in csvreader:
-        section = {
-            "id": f"{item[0]}-{item[1]}-{item[2]}",
-            "Chapter": item[0],
-            "Section": item[1],
-            "Paragraph": item[2],
-            "Content": item[3],
-            "Embedding": setup.get_embedding(item[3]),
-        }
-        sections.append(section)
-print(f"Finished Indexing: {len(sections)} items in total")
-
+# Streamed CSV -> document -> embedding -> upload, see ingest.py
+ingest(
+    TEXT, read_csv(csv_path), setup.text_search_client, setup.text_search_index_name,
+    os.path.basename(csv_path), setup.get_embeddings, setup.text_embedding_model, full=full_rebuild,
+)
 
-text_upload_results = setup.text_search_client.upload_documents(documents=sections)
-print("Uploading")
-succeeded = sum([1 for r in text_upload_results if r.succeeded])
-print(f"Indexed {len(text_upload_results)} sections, {succeeded} succeeded")
\ No newline at end of file
+# Paragraph -> image candidates for the app, from the vectors just cached
+image_csv_path = os.path.join(os.path.dirname(path), "outputupdated.csv")
+build_image_links(setup.text_search_index_name, image_csv_path, setup.get_embeddings,
+                  duplicates=find_duplicates(preferred=caption_names(image_csv_path)))
+print(f"Embedding cache: {setup.embedding_cache.stats()}")
@@ -1,10 +1,22 @@
 import os
+import sys
 import csv
-from openai import AzureOpenAI
+import json
+import time
+import random
+import asyncio
 import base64
+from io import BytesIO
 from mimetypes import guess_type
+from PIL import Image
+import openai
+from openai import AzureOpenAI, AsyncAzureOpenAI
 from dotenv import load_dotenv
 
+# Shared helpers live next to the app in Code_Reconstruct
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "Code_Reconstruct"))
+from image_dedup import find_duplicates
+
 load_dotenv()
 
 api_base = os.getenv("AZURE_OPENAI_ENDPOINT")
@@ -18,6 +30,36 @@ client = AzureOpenAI(
     base_url=f"{api_base}/openai/deployments/{deployment_name}"
 )
 
+async_client = AsyncAzureOpenAI(
+    api_key=api_key,
+    api_version=api_version,
+    base_url=f"{api_base}/openai/deployments/{deployment_name}",
+    max_retries=0,  # retries are handled below so they go through the rate limiter
+)
+
+# Limits of the deployment, set them to the quota shown in the Azure portal
+CAPTION_WORKERS = int(os.getenv("CAPTION_WORKERS", 8))
+CAPTION_RPM = int(os.getenv("CAPTION_RPM", 60))
+CAPTION_TPM = int(os.getenv("CAPTION_TPM", 80000))
+CAPTION_MAX_RETRIES = int(os.getenv("CAPTION_MAX_RETRIES", 5))
+MAX_TOKENS = 2000
+
+# GPT-4o scales every image to fit 2048x2048 and then to 768 px on the short side before
+# tiling it, so anything larger only costs upload bytes
+MAX_LONG_SIDE = 2048
+MAX_SHORT_SIDE = 768
+JPEG_QUALITY = 85
+
+systemMessage = '''You are a historian expert who can give information of a photo.
+Identify when the photo was taken, and recognize the objects and the events in the photo.
+This is your task: List the keywords that help describe this photo, and group these keywords under
+0. Story: brieftly describe image
+1. Objects:List all important object in the image
+2. Events: List all important action, events in the image
+3. Time: Estimate the time in that image (date/month/year)
+in this order. Don't bold any text.
+'''
+
 # Function to encode a local image into data URL
 def local_image_to_data_url(image_path):
     # Guess the MIME type of the image based on the file extension
@@ -32,53 +74,205 @@ def local_image_to_data_url(image_path):
     # Construct the data URL
     return f"data:{mime_type};base64,{base64_encoded_data}"
 
-# Function to process images in a folder and write results to a CSV file
-def process_images_in_folder(folder_path, output_file):
-    with open(output_file, 'w', newline='') as csvfile:
-        csvwriter = csv.writer(csvfile)
-        csvwriter.writerow(['Image Name', 'Image Path', 'Response1', 'Response2'])
+# Same as above, but the image is first shrunk to the size the model actually looks at.
+# Returns the data URL, the image size after downscaling and the number of bytes encoded.
+def downscaled_image_to_data_url(image_path):
+    with Image.open(image_path) as img:
+        img.draft('RGB', (MAX_LONG_SIDE, MAX_LONG_SIDE))
+        scale = min(1.0, MAX_LONG_SIDE / max(img.size), MAX_SHORT_SIDE / min(img.size))
+        size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+        img.thumbnail(size, reducing_gap=2.0)
+        if img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
+        img_bytes = BytesIO()
+        img.save(img_bytes, format='JPEG', quality=JPEG_QUALITY)
+    data = img_bytes.getvalue()
+    return f"data:image/jpeg;base64,{base64.b64encode(data).decode('utf-8')}", img.size, len(data)
 
-        for filename in os.listdir(folder_path):
-            if filename.endswith('.jpg') or filename.endswith('.png'):
-                image_path = os.path.join(folder_path, filename)
-                data_url = local_image_to_data_url(image_path)
+def image_tokens(size):
+    # Vision cost at detail=high: 85 base tokens plus 170 per 512 px tile
+    width, height = size
+    return 85 + 170 * (-(-width // 512)) * (-(-height // 512))
 
-                systemMessage = '''You are a historian expert who can give information of a photo. 
-Identify when the photo was taken, and recognize the objects and the events in the photo.
-This is your task: List the keywords that help describe this photo, and group these keywords under 
-0. Story: brieftly describe image
-1. Objects:List all important object in the image
-2. Events: List all important action, events in the image
-3. Time: Estimate the time in that image (date/month/year)
-in this order. Don't bold any text.
-'''
+def estimate_tokens(size):
+    # Azure counts max_tokens against the TPM quota when the request is admitted
+    return len(systemMessage) // 4 + 20 + image_tokens(size) + MAX_TOKENS
+
+class TokenBucket:
+    # Requests per minute and tokens per minute, both refilled continuously. acquire() waits
+    # until the request fits in both; refund() returns what a finished request did not use.
+    def __init__(self, rpm, tpm):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.requests = float(rpm)
+        self.tokens = float(tpm)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        elapsed = now - self.updated
+        self.updated = now
+        self.requests = min(self.rpm, self.requests + elapsed * self.rpm / 60)
+        self.tokens = min(self.tpm, self.tokens + elapsed * self.tpm / 60)
+
+    async def acquire(self, tokens):
+        tokens = min(tokens, self.tpm)
+        async with self.lock:
+            while True:
+                if time.monotonic() < self.paused_until:
+                    await asyncio.sleep(self.paused_until - time.monotonic())
+                self.refill()
+                if self.requests >= 1 and self.tokens >= tokens:
+                    self.requests -= 1
+                    self.tokens -= tokens
+                    return
+                wait = max((1 - self.requests) * 60 / self.rpm, (tokens - self.tokens) * 60 / self.tpm)
+                await asyncio.sleep(max(wait, 0.01))
+
+    def refund(self, tokens):
+        self.tokens = min(self.tpm, self.tokens + tokens)
+
+    def pause(self, seconds):
+        # After a 429 nothing should be sent until the service says so
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+def retry_after(error):
+    try:
+        return float(error.response.headers.get("retry-after"))
+    except (AttributeError, TypeError, ValueError):
+        return None
 
-                response = client.chat.completions.create(
-                    model=deployment_name,
-                    messages=[
-                        {"role": "system", "content": systemMessage},
-                        {"role": "user", "content": [
-                            {
-                                "type": "text",
-                                "text": "Describe this picture:"
-                            },
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": data_url
-                                }
+def load_checkpoint(checkpoint_file):
+    # Captions from earlier runs, one JSON object per line; a torn last line is ignored
+    done = {}
+    if os.path.exists(checkpoint_file):
+        with open(checkpoint_file, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    row = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                done[row["Image Name"]] = row
+    return done
+
+async def caption_image(image_path, bucket, stats):
+    # Decoding and resizing run in a thread so they do not stall the requests in flight
+    data_url, size, n_bytes = await asyncio.to_thread(downscaled_image_to_data_url, image_path)
+    estimate = estimate_tokens(size)
+    for attempt in range(CAPTION_MAX_RETRIES + 1):
+        await bucket.acquire(estimate)
+        try:
+            response = await async_client.chat.completions.create(
+                model=deployment_name,
+                messages=[
+                    {"role": "system", "content": systemMessage},
+                    {"role": "user", "content": [
+                        {
+                            "type": "text",
+                            "text": "Describe this picture:"
+                        },
+                        {
+                            "type": "image_url",
+                            "image_url": {
+                                "url": data_url
                             }
-                        ]}
-                    ],
-                    max_tokens=2000
-                )
+                        }
+                    ]}
+                ],
+                max_tokens=MAX_TOKENS
+            )
+        except (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError) as e:
+            if attempt == CAPTION_MAX_RETRIES:
+                raise
+            delay = retry_after(e) or min(60, 2 ** attempt) + random.random()
+            if isinstance(e, openai.RateLimitError):
+                stats["throttled"] += 1
+                bucket.pause(delay)
+            else:
+                bucket.refund(estimate)
+            await asyncio.sleep(delay)
+            continue
+        usage = response.usage
+        if usage:
+            bucket.refund(max(0, estimate - usage.total_tokens))
+            stats["prompt_tokens"] += usage.prompt_tokens
+            stats["completion_tokens"] += usage.completion_tokens
+        stats["bytes_sent"] += n_bytes
+        stats["bytes_original"] += os.path.getsize(image_path)
+        return response.choices[0].message.content
+
+async def caption_images(jobs, checkpoint_file, done, workers, stats):
+    bucket = TokenBucket(CAPTION_RPM, CAPTION_TPM)
+    queue = asyncio.Queue()
+    for job in jobs:
+        queue.put_nowait(job)
 
-                response_text = response.choices[0].message.content
+    with open(checkpoint_file, 'a', encoding='utf-8') as checkpoint:
+        async def worker():
+            while not queue.empty():
+                filename, image_path = queue.get_nowait()
+                try:
+                    response_text = await caption_image(image_path, bucket, stats)
+                except Exception as e:
+                    stats["failed"] += 1
+                    print(f"Failed to caption {filename}: {e}")
+                    continue
                 response2_text = "\n".join(response_text.split("\n")[1:])  # Exclude the "Story" section
+                row = {"Image Name": filename, "Image Path": image_path,
+                       "Response1": response_text, "Response2": response2_text}
+                # Written as soon as it is known so a crashed run loses at most the requests in flight
+                checkpoint.write(json.dumps(row, ensure_ascii=False) + "\n")
+                checkpoint.flush()
+                done[filename] = row
+                stats["captioned"] += 1
+                print(f"Captioned {filename} ({len(done)} done)")
+
+        await asyncio.gather(*(worker() for _ in range(max(1, workers))))
+
+# Function to process images in a folder and write results to a CSV file
+def process_images_in_folder(folder_path, output_file, workers=CAPTION_WORKERS):
+    # Images already in the checkpoint file are not sent again, the CSV is rewritten from it at the end
+    checkpoint_file = output_file + '.checkpoint.jsonl'
+    done = load_checkpoint(checkpoint_file)
+
+    images = []
+    for filename in sorted(os.listdir(folder_path)):
+        if filename.endswith('.jpg') or filename.endswith('.png'):
+            images.append((filename, os.path.join(folder_path, filename)))
+    # Near-duplicate copies are not captioned, an image already in the checkpoint stays the canonical one
+    duplicates = find_duplicates(folder_path, preferred=done)
+    images = [(filename, image_path) for filename, image_path in images if filename not in duplicates]
+    jobs = [(filename, image_path) for filename, image_path in images if filename not in done]
+
+    stats = {"captioned": 0, "failed": 0, "throttled": 0, "prompt_tokens": 0, "completion_tokens": 0,
+             "bytes_sent": 0, "bytes_original": 0}
+    start = time.perf_counter()
+    asyncio.run(caption_images(jobs, checkpoint_file, done, workers, stats))
+    elapsed = time.perf_counter() - start
+
+    tmp_file = output_file + '.tmp'
+    with open(tmp_file, 'w', newline='') as csvfile:
+        csvwriter = csv.writer(csvfile)
+        csvwriter.writerow(['Image Name', 'Image Path', 'Response1', 'Response2'])
+        for filename, _ in images:
+            if filename in done:
+                row = done[filename]
+                csvwriter.writerow([row["Image Name"], row["Image Path"], row["Response1"], row["Response2"]])
+    os.replace(tmp_file, output_file)
 
-                csvwriter.writerow([filename, image_path, response_text, response2_text])
+    captioned = stats["captioned"]
+    print(f"{captioned} captioned, {len(images) - len(jobs)} from checkpoint, {len(duplicates)} duplicates skipped, "
+          f"{stats['failed']} failed, {stats['throttled']} throttled in {elapsed:.1f}s ({captioned / elapsed * 60 if elapsed else 0:.1f} images/min)")
+    print(f"Tokens: {stats['prompt_tokens']} prompt, {stats['completion_tokens']} completion "
+          f"({(stats['prompt_tokens'] + stats['completion_tokens']) / elapsed * 60 if elapsed else 0:.0f} tokens/min)")
+    print(f"Uploaded {stats['bytes_sent'] / 1024 / 1024:.1f} MB for "
+          f"{stats['bytes_original'] / 1024 / 1024:.1f} MB of images")
+    return stats
 
-# Example usage
-folder_path = 'jpg'
-output_file = 'output.csv'
-process_images_in_folder(folder_path, output_file)
\ No newline at end of file
+if __name__ == '__main__':
+    # python ImageDB.py [folder_path] [output_file]
+    folder_path = sys.argv[1] if len(sys.argv) > 1 else 'jpg'
+    output_file = sys.argv[2] if len(sys.argv) > 2 else 'output.csv'
+    process_images_in_folder(folder_path, output_file)
@@ -1,36 +1,123 @@
 import os
+import sys
+import time
 from PIL import Image
 from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 # Set the input and output folders
 input_folder = 'tif'
 output_folder = 'jpg'
 
-# Create the output folder if it doesn't exist
-if not os.path.exists(output_folder):
-    os.makedirs(output_folder)
-
-# Iterate through the files in the input folder
-for filename in os.listdir(input_folder):
-    if filename.endswith('.tif'):
-        # Open the image
-        img_path = os.path.join(input_folder, filename)
-        img = Image.open(img_path)
-
-        # Resize the image to be less than 15 MB
-        img.thumbnail((1920, 1080))
-        img_bytes = BytesIO()
-        img.save(img_bytes, format='JPEG', optimize=True, quality=80)
-        img_size = img_bytes.getbuffer().nbytes
-
-        while img_size > 15 * 1024 * 1024:
-            img.thumbnail((img.width // 2, img.height // 2))
-            img_bytes = BytesIO()
-            img.save(img_bytes, format='JPEG', optimize=True, quality=80)
-            img_size = img_bytes.getbuffer().nbytes
-
-        # Save the resized image to the output folder
-        output_filename = os.path.splitext(filename)[0] + '.jpg'
-        output_path = os.path.join(output_folder, output_filename)
-        img.save(output_path, 'JPEG')
-        print(f'Converted {filename} to {output_filename}')
\ No newline at end of file
+MAX_SIZE = (1920, 1080)           # fits the GPT vision input
+MAX_BYTES = 15 * 1024 * 1024      # keep every image under 15 MB
+QUALITY = 80
+MIN_QUALITY = 40
+MAX_ENCODES = 6                   # bound on trial encodes per image
+
+def is_up_to_date(img_path, output_path):
+    # Converted on an earlier run and the scan has not been touched since
+    return os.path.exists(output_path) and os.path.getmtime(output_path) >= os.path.getmtime(img_path)
+
+REDUCED_RESOLUTION = 1 # bit 0 of the TIFF NewSubfileType tag (254): a reduced copy of frame 0
+
+def select_reduced(img, size):
+    # Decode no more pixels than needed: JPEG sources decode at a reduced scale with draft(),
+    # pyramidal TIFFs use the smallest reduced-resolution level that still covers the target size.
+    # Other TIFF pages are separate images, frame 0 is the scan itself
+    if img.format == 'JPEG':
+        img.draft('RGB', size)
+    elif img.format == 'TIFF' and getattr(img, 'n_frames', 1) > 1:
+        best = (img.width * img.height, 0)
+        for frame in range(1, img.n_frames):
+            img.seek(frame)
+            reduced = img.tag_v2.get(254, 0) & REDUCED_RESOLUTION
+            if reduced and (img.width >= size[0] or img.height >= size[1]):
+                best = min(best, (img.width * img.height, frame))
+        img.seek(best[1])
+
+def encode(img, quality):
+    img_bytes = BytesIO()
+    img.save(img_bytes, format='JPEG', optimize=True, quality=quality)
+    return img_bytes.getvalue()
+
+def encode_within_limit(img):
+    # Highest quality (up to QUALITY) under MAX_BYTES with a bounded binary search, halving the
+    # image only if even MIN_QUALITY is too large. The accepted encode is the one written out.
+    data = encode(img, QUALITY)
+    if len(data) <= MAX_BYTES:
+        return data, QUALITY
+    high = QUALITY - 1
+    while True:
+        low, best, encodes = MIN_QUALITY, None, 0
+        while low <= high and encodes < MAX_ENCODES:
+            quality = (low + high) // 2
+            candidate = encode(img, quality)
+            encodes += 1
+            if len(candidate) <= MAX_BYTES:
+                best = (candidate, quality)
+                low = quality + 1
+            else:
+                high = quality - 1
+        if best:
+            return best
+        img.thumbnail((img.width // 2, img.height // 2), reducing_gap=2.0)
+        high = QUALITY
+
+def convert(img_path, output_path):
+    with Image.open(img_path) as img:
+        select_reduced(img, MAX_SIZE)
+        # reducing_gap lets Pillow shrink by whole factors first, much cheaper than a full resample
+        img.thumbnail(MAX_SIZE, reducing_gap=2.0)
+        if img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
+        data, quality = encode_within_limit(img)
+    tmp_path = output_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, output_path)
+    return os.path.getsize(img_path), len(data), quality
+
+def main(input_folder=input_folder, output_folder=output_folder, workers=None):
+    # Create the output folder if it doesn't exist
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder)
+
+    jobs = []
+    skipped = 0
+    for filename in os.listdir(input_folder):
+        if filename.endswith('.tif'):
+            img_path = os.path.join(input_folder, filename)
+            output_filename = os.path.splitext(filename)[0] + '.jpg'
+            output_path = os.path.join(output_folder, output_filename)
+            if is_up_to_date(img_path, output_path):
+                skipped += 1
+                continue
+            jobs.append((filename, output_filename, img_path, output_path))
+
+    start = time.perf_counter()
+    converted, failed, bytes_in, bytes_out = 0, 0, 0, 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(convert, img_path, output_path): (filename, output_filename)
+                   for filename, output_filename, img_path, output_path in jobs}
+        for future in as_completed(futures):
+            filename, output_filename = futures[future]
+            try:
+                size_in, size_out, quality = future.result()
+            except Exception as e:
+                failed += 1
+                print(f'Failed to convert {filename}: {e}')
+                continue
+            converted += 1
+            bytes_in += size_in
+            bytes_out += size_out
+            print(f'Converted {filename} to {output_filename} (quality {quality})')
+
+    elapsed = time.perf_counter() - start
+    print(f'{converted} converted, {skipped} up to date, {failed} failed in {elapsed:.1f}s '
+          f'({converted / elapsed if elapsed else 0:.1f} files/s), '
+          f'{(bytes_in - bytes_out) / 1024 / 1024:.1f} MB saved')
+
+if __name__ == '__main__':
+    # python convert.py [input_folder] [output_folder]
+    main(*sys.argv[1:3])
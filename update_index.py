@@ -1,5 +1,5 @@
 import os
-import csv
+import sys
 from dotenv import load_dotenv, find_dotenv
 from pypdf import PdfReader, PdfWriter
 from pypdf import PdfReader, PdfWriter
@@ -8,8 +8,15 @@ from openai import AzureOpenAI
 from azure.core.credentials import AzureKeyCredential
 from azure.search.documents import SearchClient
 from azure.search.documents.indexes import SearchIndexClient
-from azure.search.documents.indexes.models import *
-from azure.search.documents.models import VectorizedQuery
+
+# Shared helpers live next to the app in Code_Reconstruct
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "Code_Reconstruct"))
+import embeddings
+from embedding_cache import EmbeddingCache, DEFAULT_PATH
+from ingest import ingest, read_csv
+from image_dedup import find_duplicates, caption_names, unique_rows
+from image_links import build_image_links
+from schemas import TEXT, IMAGE
 
 # Get Environment Settings from .env file
 load_dotenv(find_dotenv())
@@ -39,122 +46,43 @@ azure_openai_client = AzureOpenAI(
 
 print("Successfully validated azure credentials")
 
+# Only new or changed rows are embedded and uploaded, pass --full to rebuild everything
+full_rebuild = "--full" in sys.argv
+
+# Unchanged rows are served from the embedding cache shared with the app
+embedding_cache = EmbeddingCache(os.getenv("EMBEDDING_CACHE_PATH", DEFAULT_PATH))
+
 # Embedding model for indexing database and search queries
 def get_embedding(text, model="textembedding"): # model=[Deployment Name], DONOT change this
-   text = text.replace("\n", " ")
-   return azure_openai_client.embeddings.create(input = [text], model=model).data[0].embedding
-
-# Index the text database
-sections = []
-with open('./OHNO/ch1to3.csv', 'rt', newline='', encoding='utf-8', errors='ignore') as csvfile:
-    csvreader = csv.reader(csvfile)
-    for item in csvreader:
-        section = {
-            "id": f"{item[0]}-{item[1]}-{item[2]}",
-            "Chapter": item[0],
-            "Section": item[1],
-            "Paragraph": item[2],
-            "Content": item[3],
-            "Embedding": get_embedding(item[3]),
-        }
-        sections.append(section)
-print(f"Finished Indexing: {len(sections)} items in total")
-
-# Update azure search text index
-text_index = SearchIndex(
-    name=text_index_name,
-    fields=[
-        SimpleField(name="id", type="Edm.String", key=True),
-        SearchableField(name="Chapter", type="Edm.String", analyzer_name="standard.lucene", 
-                        filterable=True, sortable=True, facetable=True, searchable=True),
-        SearchableField(name="Section", type="Edm.String", analyzer_name="standard.lucene",
-                        filterable=True, sortable=True, facetable=True, searchable=True),
-        SearchableField(name="Paragraph", type="Edm.String", analyzer_name="standard.lucene",
-                        filterable=True, sortable=True, facetable=True, searchable=True),        
-        SearchableField(name="Content", type="Edm.String", analyzer_name="standard.lucene",
-                        filterable=True, sortable=True, facetable=True, searchable=True),
-        SearchField(name="Embedding", type=SearchFieldDataType.Collection(SearchFieldDataType.Single),  
-            hidden=False, searchable=True, filterable=False, sortable=False, facetable=False,
-            vector_search_dimensions=1536, vector_search_profile_name="my-vector-config"),
-    ],
-    vector_search=VectorSearch(
-        profiles=[VectorSearchProfile(
-            name="my-vector-config",
-            algorithm_configuration_name="my-hnsw")
-        ],
-        algorithms=[
-            HnswAlgorithmConfiguration(name="my-hnsw")
-        ]
-    )
-)
-text_index_client.create_or_update_index(text_index)
+   return get_embeddings([text], model=model)[0].tolist()
 
-results = text_search_client.upload_documents(documents=sections)
-print("Uploading")
-succeeded = sum([1 for r in results if r.succeeded])
-print(f"Indexed {len(results)} sections, {succeeded} succeeded")
-batch = []
+# Batched embedding, packs many rows into each request and keeps the input order
+def get_embeddings(texts, model="textembedding"): # model=[Deployment Name], DONOT change this
+   return embeddings.get_embeddings(azure_openai_client, texts, model, cache=embedding_cache)
+
+# Index the text database, streamed CSV -> document -> embedding -> upload
+TEXT.create_or_update(text_index_client, text_index_name)
+ingest(
+    TEXT, read_csv('./OHNO/ch1to3.csv'), text_search_client, text_index_name, "ch1to3.csv",
+    get_embeddings, "textembedding", full=full_rebuild,
+)
 
 print("Successfully updated text index")
 
 
 
 
-# Index the image database
-sections = []
-with open('./OHNO/outputupdated.csv', 'rt', newline='', encoding='utf-8', errors='ignore') as csvfile:
-    csvreader = csv.reader(csvfile)
-    item_num = 0
-    for item in csvreader:
-        section = {
-            "id": f"{item_num}",
-            "Image_name": item[0],
-            "Image_path": item[1],
-            "Response1": item[2],
-            "Response2": item[3],
-            "Caption": item[4],
-            "Embedding": get_embedding(''.join(item[0:5]))
-        }
-        item_num += 1
-        sections.append(section)
-print(f"Finished Indexing: {len(sections)} items in total")
-
-# Update azure search image index
-image_index = SearchIndex(
-    name=image_index_name,
-    fields=[
-        SimpleField(name="id", type="Edm.String", key=True),
-        SearchableField(name="Image_name", type="Edm.String", analyzer_name="standard.lucene", 
-                        filterable=True, sortable=True, facetable=True, searchable=True),
-        SearchableField(name="Image_path", type="Edm.String", analyzer_name="standard.lucene",
-                        filterable=True, sortable=True, facetable=True, searchable=True),
-        SearchableField(name="Response1", type="Edm.String", analyzer_name="standard.lucene",
-                        filterable=True, sortable=True, facetable=True, searchable=True),
-        SearchableField(name="Response2", type="Edm.String", analyzer_name="standard.lucene",
-                        filterable=True, sortable=True, facetable=True, searchable=True),
-        SearchableField(name="Caption", type="Edm.String", analyzer_name="standard.lucene",
-                        filterable=True, sortable=True, facetable=True, searchable=True),
-        SearchField(name="Embedding", type=SearchFieldDataType.Collection(SearchFieldDataType.Single),  
-            hidden=False, searchable=True, filterable=False, sortable=False, facetable=False,
-            vector_search_dimensions=1536, vector_search_profile_name="my-vector-config"),
-    ],
-    vector_search=VectorSearch(
-        profiles=[VectorSearchProfile(
-            name="my-vector-config",
-            algorithm_configuration_name="my-hnsw")
-        ],
-        algorithms=[
-            HnswAlgorithmConfiguration(name="my-hnsw")
-        ]
-    )
+# Index the image database, same schema and embedded text as Code_Reconstruct/update_image_index.py
+# Near-duplicate copies of an image are left out, see Code_Reconstruct/image_dedup.py
+IMAGE.create_or_update(image_index_client, image_index_name)
+duplicates = find_duplicates('./jpg', preferred=caption_names('./OHNO/outputupdated.csv'))
+ingest(
+    IMAGE, unique_rows(read_csv('./OHNO/outputupdated.csv'), duplicates), image_search_client, image_index_name, "outputupdated.csv",
+    get_embeddings, "textembedding", full=full_rebuild, sole_source=True,
 )
 
-image_index_client.create_or_update_index(image_index)
-
-results = image_search_client.upload_documents(documents=sections)
-print("Uploading")
-succeeded = sum([1 for r in results if r.succeeded])
-print(f"Indexed {len(results)} sections, {succeeded} succeeded")
-batch = []
+print("Successfully updated image index")
 
-print("Successfully updated image index")
\ No newline at end of file
+# Paragraph -> image candidates for the app, from the vectors just cached
+build_image_links(text_index_name, './OHNO/outputupdated.csv', get_embeddings, duplicates=duplicates)
+print(f"Embedding cache: {embedding_cache.stats()}")